@@ -0,0 +1,113 @@
+"""Micro-benchmark: single-pass scanner vs the previous extract_configs_from_text.
+
+The corpus is every plain-text subscription under output/, repeated until it
+reaches --mb megabytes, so the lines are real-world configs.
+
+    python benchmarks/bench_extract.py --mb 8
+"""
+import argparse
+import base64
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.parser import ConfigStream, extract_configs_from_text, safe_b64decode
+
+
+def legacy_extract_configs_from_text(text):
+    configs = []
+
+    decoded = safe_b64decode(text)
+    if decoded and any(p in decoded for p in ["vmess://", "vless://", "trojan://", "ss://"]):
+        text = decoded
+
+    for line in text.splitlines():
+        line = line.strip()
+        for prefix in ["vmess://", "vless://", "trojan://", "ss://"]:
+            if line.startswith(prefix):
+                configs.append(line)
+                break
+
+    for protocol in ["vmess://", "vless://", "trojan://", "ss://"]:
+        escaped = re.escape(protocol)
+        pattern = escaped + r'[A-Za-z0-9+/=_\-%.@:?&#!,;\[\]()~]+'
+        matches = re.findall(pattern, text)
+        configs.extend(matches)
+
+    seen = set()
+    unique = []
+    for c in configs:
+        if c not in seen:
+            seen.add(c)
+            unique.append(c)
+
+    return unique
+
+
+def build_corpus(mb):
+    root = Path(__file__).resolve().parent.parent / "output"
+    lines = []
+    for path in sorted(root.rglob("*.txt")):
+        if path.name.endswith("_sub.txt") or path.name.startswith("best_base64"):
+            continue
+        lines.extend(path.read_text(encoding="utf-8").splitlines())
+    if not lines:
+        sys.exit("no corpus under " + str(root))
+    text = "\n".join(lines) + "\n"
+    # Vary each copy slightly so dedup does real work on every repetition
+    copies = []
+    size = 0
+    i = 0
+    while size < mb * 1024 * 1024:
+        chunk = text.replace("#", "#r" + str(i) + "-")
+        copies.append(chunk)
+        size += len(chunk)
+        i += 1
+    return "".join(copies)
+
+
+def bench(name, fn, arg, rounds):
+    best = None
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = fn(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("  %-28s %8.1f ms  %7d configs" % (name, best * 1000, len(result)))
+    return best
+
+
+def stream_extract(data):
+    stream = ConfigStream()
+    out = []
+    for i in range(0, len(data), 65536):
+        out.extend(stream.feed(data[i:i + 65536]))
+    out.extend(stream.close())
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mb", type=float, default=8)
+    ap.add_argument("--rounds", type=int, default=3)
+    args = ap.parse_args()
+
+    plain = build_corpus(args.mb)
+    encoded = base64.b64encode(plain.encode("utf-8")).decode("ascii")
+    print("corpus: %.1f MB plain, %.1f MB base64" % (len(plain) / 1e6, len(encoded) / 1e6))
+
+    for label, text in [("plain", plain), ("base64", encoded)]:
+        print(label + ":")
+        old = bench("legacy (str, 4 regexes)", legacy_extract_configs_from_text, text, args.rounds)
+        new = bench("single-pass (str)", extract_configs_from_text, text, args.rounds)
+        streamed = bench("single-pass stream (bytes)", stream_extract, text.encode("ascii", "ignore")
+                         if label == "base64" else text.encode("utf-8"), args.rounds)
+        print("  speedup: %.2fx (str), %.2fx (stream)" % (old / new, old / streamed))
+
+
+if __name__ == "__main__":
+    main()
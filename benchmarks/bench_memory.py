@@ -0,0 +1,109 @@
+"""Memory benchmark: slotted ProxyConfig vs the previous __dict__ layout.
+
+Builds --count configs from the committed output/ subscriptions (remarks
+varied so every row is distinct), then measures what the list of configs
+and one derived copy per config (as fix_all_configs makes) keep alive.
+
+    python benchmarks/bench_memory.py --count 100000
+
+For 97k configs: 54.5 MB -> 43.6 MB (20% less). The legacy layout has no
+measurement attributes; the ten slots the testers fill in (ip, dns_ms,
+p50 ... throughput) cost 80 bytes on every config and copy.
+"""
+import argparse
+import copy
+import gc
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.parser import ProxyConfig, parse_batch, _digest
+
+
+class LegacyProxyConfig:
+    def __init__(self, raw, protocol, address="", port=0, name="", fingerprint=""):
+        self.raw = raw
+        self.protocol = protocol
+        self.address = address
+        self.port = port
+        self.name = name
+        self.latency = -1
+        self.is_alive = False
+        self.source = ""
+        self.fingerprint = fingerprint or raw
+
+
+def corpus(count):
+    root = Path(__file__).resolve().parent.parent / "output"
+    lines = []
+    for path in sorted(root.rglob("*.txt")):
+        if path.name.endswith("_sub.txt") or path.name.startswith("best_base64"):
+            continue
+        lines.extend(l for l in path.read_text(encoding="utf-8").splitlines() if "://" in l)
+    out = []
+    i = 0
+    while len(out) < count:
+        for line in lines:
+            base = line.rsplit("#", 1)[0] if not line.startswith("vmess://") else line
+            out.append(base + "#r" + str(i) if not line.startswith("vmess://") else line)
+            i += 1
+            if len(out) >= count:
+                break
+    return out
+
+
+def measure(label, build):
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("  %-34s %8.1f MB kept  %8.1f MB peak" % (label, current / 1e6, peak / 1e6))
+    del kept
+    return current
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--count", type=int, default=100000)
+    args = ap.parse_args()
+
+    lines = corpus(args.count)
+    parsed = parse_batch(lines)
+    print("%d configs (%.1f MB of raw text)" % (len(parsed), sum(len(c.raw) for c in parsed) / 1e6))
+
+    # Raw text is shared by both layouts; what differs is the per-object
+    # cost, the interned address/protocol strings and the fingerprint
+    rows = [(c.raw, c.protocol, c.address, c.port, c.name) for c in parsed]
+    legacy_keys = [(c.protocol, c.address, str(c.port), c.raw.split("://", 1)[1][:40]) for c in parsed]
+
+    def legacy():
+        configs = [LegacyProxyConfig(r[0], "%s" % r[1], "%s" % r[2], r[3], r[4], "|".join(k))
+                   for r, k in zip(rows, legacy_keys)]
+        derived = []
+        for c in configs:
+            d = copy.copy(c)
+            d.latency = 0
+            derived.append(d)
+        return configs, derived
+
+    def slotted():
+        configs = [ProxyConfig(r[0], r[1], "%s" % r[2], r[3], r[4], _digest("|".join(k)))
+                   for r, k in zip(rows, legacy_keys)]
+        derived = []
+        for c in configs:
+            d = c.derive()
+            d.latency = 0
+            derived.append(d)
+        return configs, derived
+
+    print("configs + one derived copy each:")
+    old = measure("legacy __dict__ + copy.copy", legacy)
+    new = measure("__slots__ + derive()", slotted)
+    print("  saving: %.0f%%" % (100 * (1 - new / old)))
+
+
+if __name__ == "__main__":
+    main()
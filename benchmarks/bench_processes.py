@@ -0,0 +1,45 @@
+"""Benchmark: test_batch scaling over 1..N probe processes on local targets.
+
+Uses the same loopback targets as bench_tester.py. Each process runs its
+own event loop (or thread pool) over a share of the subnets, so the gain
+is bounded by the cores the runner has.
+
+    python benchmarks/bench_processes.py --count 20000 --max-processes 4
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.bench_tester import build_targets, run
+from src.tester import ConfigTester
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--count", type=int, default=20000)
+    ap.add_argument("--timeout", type=float, default=1)
+    ap.add_argument("--dead", type=float, default=0.3, help="share of refused targets")
+    ap.add_argument("--stuck", type=float, default=0.2, help="share of targets that time out")
+    ap.add_argument("--mode", choices=("async", "thread"), default="async")
+    ap.add_argument("--concurrency", type=int, default=2000, help="total across processes")
+    ap.add_argument("--max-processes", type=int, default=os.cpu_count() or 1)
+    args = ap.parse_args()
+
+    configs, keep = build_targets(args.count, args.dead, args.stuck)
+    print("%d targets, timeout %.1fs, %s mode, %d cores" % (args.count, args.timeout, args.mode, os.cpu_count() or 1))
+    base = None
+    processes = 1
+    while processes <= args.max_processes:
+        tester = ConfigTester(timeout=args.timeout, mode=args.mode, max_workers=200,
+                              concurrency=args.concurrency, processes=processes)
+        elapsed = run(str(processes) + " process(es)", tester, configs)
+        base = base or elapsed
+        print("  %-24s %7.1fx" % ("", base / elapsed))
+        processes *= 2
+
+
+if __name__ == "__main__":
+    main()
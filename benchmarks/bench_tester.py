@@ -0,0 +1,108 @@
+"""Benchmark: asyncio test_batch vs the thread pool on local targets.
+
+Targets are loopback listeners (alive), closed ports (refused) and
+listeners with a full accept backlog whose SYNs get dropped, so those probes
+run into the timeout like dead servers do in production. Each target gets
+its own 127.x.y.z address, with listeners bound to that address only, so
+the tester's endpoint dedup does not fold them together.
+
+    python benchmarks/bench_tester.py --count 5000 --timeout 1
+"""
+import argparse
+import socket
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.limits import raise_fd_limit
+from src.parser import ProxyConfig
+from src.tester import ConfigTester
+
+
+def loopback(n):
+    return "127." + str(n >> 16 & 255) + "." + str(n >> 8 & 255) + "." + str(n & 255)
+
+
+def listener(address, backlog=4096):
+    s = socket.socket()
+    s.bind((address, 0))
+    s.listen(backlog)
+    return s
+
+
+def closed_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def stuck_listener(address):
+    # Backlog 0 and never accept: once the queue is full further SYNs are dropped
+    s = listener(address, 0)
+    filler = []
+    for _ in range(4):
+        f = socket.socket()
+        f.setblocking(False)
+        f.connect_ex((address, s.getsockname()[1]))
+        filler.append(f)
+    return [s] + filler
+
+
+def build_targets(count, dead_ratio, stuck_ratio):
+    # Every listener is bound to its own target address only, never to all interfaces
+    raise_fd_limit()
+    closed = closed_port()
+    configs = []
+    keep = []
+    for i in range(count):
+        r = (i % 100) / 100.0
+        ip = loopback(i + 1)
+        if r < stuck_ratio:
+            socks = stuck_listener(ip)
+            keep.extend(socks)
+            port = socks[0].getsockname()[1]
+        elif r < stuck_ratio + dead_ratio:
+            port = closed
+        else:
+            keep.append(listener(ip))
+            port = keep[-1].getsockname()[1]
+        configs.append(ProxyConfig("bench://" + str(i), "vless", ip, port))
+    # Let the filler connects fill the stuck backlogs
+    time.sleep(0.2)
+    return configs, keep
+
+
+def run(label, tester, configs):
+    for c in configs:
+        c.latency, c.is_alive = -1, False
+    start = time.perf_counter()
+    tested = tester.test_batch(configs)
+    elapsed = time.perf_counter() - start
+    alive = sum(1 for c in tested if c.is_alive)
+    print("  %-24s %7.2f s  %8.0f probes/s  alive %d/%d" % (label, elapsed, len(configs) / elapsed, alive, len(configs)))
+    return elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--count", type=int, default=5000)
+    ap.add_argument("--timeout", type=float, default=1)
+    ap.add_argument("--dead", type=float, default=0.3, help="share of refused targets")
+    ap.add_argument("--stuck", type=float, default=0.2, help="share of targets that time out")
+    ap.add_argument("--concurrency", type=int, default=2000)
+    args = ap.parse_args()
+
+    configs, keep = build_targets(args.count, args.dead, args.stuck)
+    print("%d targets, timeout %.1fs" % (args.count, args.timeout))
+    threaded = run("thread pool (200)", ConfigTester(timeout=args.timeout, max_workers=200), configs)
+    asynced = run("asyncio (" + str(args.concurrency) + ")",
+                  ConfigTester(timeout=args.timeout, mode="async", concurrency=args.concurrency), configs)
+    print("  speedup: %.1fx" % (threaded / asynced))
+
+
+if __name__ == "__main__":
+    main()
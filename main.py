@@ -1,9 +1,16 @@
+import argparse
 import logging
+import os
 import sys
 from pathlib import Path
 from src.collector import ConfigCollector
 from src.tester import ConfigTester
+from src.history import LatencyHistory
+from src.pipeline import ProbePipeline
+from src.scheduler import RunBudget, prior_score
+from src.shard import parse_shard, in_shard, save_shard, load_shards
 from src.cleaner import load_clean_ips, apply_clean_ips, filter_cdn_configs
+from src.cdn_tester import test_cdn_batch, balance_ports
 from src.antifilter import fix_all_configs
 from src.fragment import generate_fragment_configs
 from src.warp import save_warp
@@ -12,25 +19,61 @@ from src.utils import save_txt, save_base64, save_json, save_by_protocol, genera
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s", datefmt="%H:%M:%S")
 logger = logging.getLogger(__name__)
 
+# The workflow job is killed at 25 minutes; checkout, install and push
+# need a few of those, and saving the outputs after testing needs the rest
+RUN_BUDGET_MINUTES = 20
+OUTPUT_RESERVE_SECONDS = 180
+# Of those, what the CDN speed test leaves for writing the outputs after it
+SPEED_RESERVE_SECONDS = 60
+RESULT_DIR = "results"
 
-def main():
-    OUTPUT_DIR = "output"
-    Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
 
+def collect_and_test(budget, shard=None):
     # Collect
     logger.info("=== Collecting ===")
-    collector = ConfigCollector(sources_file="sources.json")
+    collector = ConfigCollector(sources_file="sources.json", mode="async")
     all_configs = collector.collect_all()
     if not all_configs:
         sys.exit(1)
+    if shard:
+        all_configs = [c for c in all_configs if in_shard(c, *shard)]
+        logger.info("Shard " + str(shard[0]) + "/" + str(shard[1]) + ": " + str(len(all_configs)) + " configs")
 
-    # Quick test
+    # TCP gate for everything, then TLS and transport checks on survivors
     logger.info("=== Testing ===")
-    tester = ConfigTester(timeout=3, max_workers=200)
-    tested = tester.test_batch(all_configs)
+    history = LatencyHistory()
+    tester = ConfigTester(timeout=3, max_workers=200, mode="async", concurrency=1000,
+                          history=history, samples=3, processes=os.cpu_count() or 1,
+                          prior=lambda c: prior_score(c, history, collector.ledger))
+    budget.log("Collected")
+    tested = ProbePipeline(tester).run(all_configs, deadline=budget.deadline(OUTPUT_RESERVE_SECONDS))
+    budget.log("Tested")
+    if not shard:
+        # A shard saw only its share; --merge records the whole run once
+        collector.record_alive(tested)
+    return tester, all_configs, tested
+
+
+def merge_shards(result_dir):
+    """Configs of every shard under result_dir, with their histories folded into
+    cache/history.db and their verdicts into the source ledger"""
+    tested = load_shards(result_dir)
+    if not tested:
+        sys.exit(1)
+    history = LatencyHistory()
+    shards = [LatencyHistory(str(p)) for p in sorted(Path(result_dir).rglob("history.db"))]
+    history.merge(shards)
+    history.save()
+    ConfigCollector(sources_file="sources.json").record_alive(tested)
+    return history, tested
+
+
+def publish(tester, all_configs, tested, budget, cdn_speed=0):
+    OUTPUT_DIR = "output"
+    Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
     alive_all = [c for c in tested if c.is_alive]
 
-    best = tester.get_best(tested, top_n=200, max_latency=2000)
+    best = tester.get_best(tested, top_n=200, max_latency=2000, rank="stability")
     if not best:
         save_txt(all_configs, OUTPUT_DIR + "/all.txt")
         sys.exit(1)
@@ -56,6 +99,15 @@ def main():
                 seen.add(key)
                 cdn_unique.append(c)
 
+        if cdn_speed:
+            # Rank by what users feel: download speed through each edge.
+            # Probed on copies so the TCP results above stay as they were
+            probes = [c.derive({}) for c in cdn_unique]
+            test_cdn_batch(probes, processes=os.cpu_count() or 1, size=cdn_speed, speed=True,
+                           deadline=budget.deadline(SPEED_RESERVE_SECONDS))
+            fastest = balance_ports([c for c in probes if c.is_alive], total=500, rank="throughput")
+            cdn_unique = fastest or cdn_unique
+
         cdn_fixed = fix_all_configs(cdn_unique[:500])
         cdn_count = len(cdn_fixed)
 
@@ -64,6 +116,8 @@ def main():
         save_txt(cdn_fixed, cdn_dir + "/best.txt")
         save_base64(cdn_fixed, cdn_dir + "/best_sub.txt")
         save_by_protocol(cdn_fixed, cdn_dir)
+        if cdn_speed:
+            save_json(cdn_fixed, cdn_dir + "/best.json")
 
     # Clean IP from ALL CDN configs
     logger.info("=== Clean IP ===")
@@ -106,5 +160,30 @@ def main():
     logger.info("WARP: " + str(warp_count))
 
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", type=float, default=RUN_BUDGET_MINUTES,
+                        help="minutes this run may take before outputs must be written")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="test only the i-th of N fingerprint partitions and write a shard result")
+    parser.add_argument("--merge", metavar="DIR",
+                        help="combine the shard results in DIR and write the outputs")
+    parser.add_argument("--results", default=RESULT_DIR, help="directory for shard result files")
+    parser.add_argument("--cdn-speed", type=int, default=0, metavar="BYTES",
+                        help="download BYTES through each CDN edge and rank the CDN output by throughput")
+    args = parser.parse_args()
+    budget = RunBudget(args.budget * 60)
+
+    if args.merge:
+        history, tested = merge_shards(args.merge)
+        publish(ConfigTester(history=history), tested, tested, budget, args.cdn_speed)
+    elif args.shard:
+        _, _, tested = collect_and_test(budget, args.shard)
+        save_shard(tested, args.results, *args.shard)
+    else:
+        tester, all_configs, tested = collect_and_test(budget)
+        publish(tester, all_configs, tested, budget, args.cdn_speed)
+
+
 if __name__ == "__main__":
     main()
@@ -1,9 +1,6 @@
-import base64
-import json
-import urllib.parse
-import copy
 import logging
 from src.geoip import get_flag
+from src.resolver import is_ip
 
 logger = logging.getLogger(__name__)
 
@@ -11,123 +8,116 @@ PREFIX = "mwri\U0001F9D8\U0001F3FD"
 TLS_PORTS = [443, 8443, 2053, 2083, 2087, 2096]
 
 
-def fix_vmess(raw, number):
-    try:
-        b64 = raw.replace("vmess://", "")
-        padding = 4 - len(b64) % 4
-        if padding != 4:
-            b64 += "=" * padding
-        try:
-            decoded = base64.b64decode(b64).decode("utf-8", errors="ignore")
-        except Exception:
-            decoded = base64.urlsafe_b64decode(b64).decode("utf-8", errors="ignore")
-        data = json.loads(decoded)
-
-        address = data.get("add", "")
-        port = int(data.get("port", 0))
-
-        if not data.get("host"):
-            data["host"] = address
-
-        if port in TLS_PORTS:
-            data["tls"] = "tls"
-            if not data.get("sni"):
-                data["sni"] = data.get("host", address)
-            if not data.get("alpn"):
-                data["alpn"] = "h2,http/1.1"
-            if not data.get("fp"):
-                data["fp"] = "chrome"
-            # Fix EOF: allowInsecure
-            data["allowInsecure"] = True
-        else:
-            data["tls"] = ""
-
-        flag = get_flag(address)
-        data["ps"] = flag + " " + PREFIX + " #" + str(number)
-
-        new_json = json.dumps(data, ensure_ascii=False)
-        return "vmess://" + base64.b64encode(new_json.encode("utf-8")).decode("utf-8")
-    except Exception:
-        return None
-
+def _pinned_ip(config, host):
+    """Address that won the tester's connect race, if the config names a hostname.
 
-def fix_vless(raw, number):
-    try:
-        parsed = urllib.parse.urlparse(raw)
-        host = parsed.hostname or ""
-        port = parsed.port or 0
-        userinfo = parsed.username or ""
-        params = dict(urllib.parse.parse_qsl(parsed.query))
+    Pinning it keeps users on the fastest edge; sni/host keep the hostname.
+    """
+    if config.is_alive and config.ip and config.ip != host and not is_ip(host):
+        return config.ip
+    return None
 
-        if not params.get("host"):
-            params["host"] = host
 
-        if port in TLS_PORTS:
-            if params.get("security", "") != "reality":
-                params["security"] = "tls"
-            if not params.get("sni"):
-                params["sni"] = params.get("host", host)
-            if not params.get("alpn"):
-                params["alpn"] = "h2,http/1.1"
-            if not params.get("fp"):
-                params["fp"] = "chrome"
-            params["allowInsecure"] = "1"
-        else:
-            params["security"] = "none"
-            params.pop("sni", None)
-            params.pop("alpn", None)
-
-        flag = get_flag(host)
-        name = flag + " " + PREFIX + " #" + str(number)
-        query = urllib.parse.urlencode(params)
-        encoded_name = urllib.parse.quote(name, safe="")
-        return "vless://" + userinfo + "@" + host + ":" + str(port) + "?" + query + "#" + encoded_name
-    except Exception:
+def fix_vmess(config, number):
+    data = config.fields
+    if not data:
         return None
-
-
-def fix_trojan(raw, number):
-    try:
-        parsed = urllib.parse.urlparse(raw)
-        host = parsed.hostname or ""
-        port = parsed.port or 0
-        password = parsed.username or ""
-        params = dict(urllib.parse.parse_qsl(parsed.query))
-
-        if not params.get("sni"):
-            params["sni"] = host
-        if not params.get("alpn"):
+    address, port = config.endpoint()
+    changes = {}
+
+    if not data.get("host"):
+        changes["host"] = address
+
+    if port in TLS_PORTS:
+        changes["tls"] = "tls"
+        if not data.get("sni"):
+            changes["sni"] = data.get("host") or address
+        if not data.get("alpn"):
+            changes["alpn"] = "h2,http/1.1"
+        if not data.get("fp"):
+            changes["fp"] = "chrome"
+        # Fix EOF: allowInsecure
+        changes["allowInsecure"] = True
+    else:
+        changes["tls"] = ""
+
+    pinned = _pinned_ip(config, address)
+    if pinned:
+        changes["add"] = pinned
+
+    flag = get_flag(address)
+    changes["ps"] = flag + " " + PREFIX + " #" + str(number)
+    return config.derive(changes)
+
+
+def fix_vless(config, number):
+    if not config.fields:
+        return None
+    host, port = config.endpoint()
+    params = {}
+
+    if not config.param("host"):
+        params["host"] = host
+
+    if port in TLS_PORTS:
+        if config.param("security") != "reality":
+            params["security"] = "tls"
+        if not config.param("sni"):
+            params["sni"] = config.param("host") or host
+        if not config.param("alpn"):
             params["alpn"] = "h2,http/1.1"
-        if not params.get("fp"):
+        if not config.param("fp"):
             params["fp"] = "chrome"
         params["allowInsecure"] = "1"
+    else:
+        params["security"] = "none"
+        params["sni"] = None
+        params["alpn"] = None
+
+    flag = get_flag(host)
+    changes = {"name": flag + " " + PREFIX + " #" + str(number)}
+    pinned = _pinned_ip(config, host)
+    if pinned:
+        changes["host"] = pinned
+    return config.derive(changes, params)
+
 
-        flag = get_flag(host)
-        name = flag + " " + PREFIX + " #" + str(number)
-        query = urllib.parse.urlencode(params)
-        encoded_name = urllib.parse.quote(name, safe="")
-        return "trojan://" + password + "@" + host + ":" + str(port) + "?" + query + "#" + encoded_name
-    except Exception:
+def fix_trojan(config, number):
+    if not config.fields:
         return None
+    host, _ = config.endpoint()
+    params = {}
+
+    if not config.param("sni"):
+        params["sni"] = host
+    if not config.param("alpn"):
+        params["alpn"] = "h2,http/1.1"
+    if not config.param("fp"):
+        params["fp"] = "chrome"
+    params["allowInsecure"] = "1"
+
+    flag = get_flag(host)
+    changes = {"name": flag + " " + PREFIX + " #" + str(number)}
+    pinned = _pinned_ip(config, host)
+    if pinned:
+        changes["host"] = pinned
+        if not config.param("host"):
+            params["host"] = host
+    return config.derive(changes, params)
 
 
 def fix_all_configs(configs):
     fixed = []
     for i, c in enumerate(configs, 1):
-        new_raw = None
+        new_c = None
         if c.protocol == "vmess":
-            new_raw = fix_vmess(c.raw, i)
+            new_c = fix_vmess(c, i)
         elif c.protocol == "vless":
-            new_raw = fix_vless(c.raw, i)
+            new_c = fix_vless(c, i)
         elif c.protocol == "trojan":
-            new_raw = fix_trojan(c.raw, i)
-
-        if new_raw:
-            new_c = copy.copy(c)
-            new_c.raw = new_raw
-            fixed.append(new_c)
-        else:
-            fixed.append(c)
+            new_c = fix_trojan(c, i)
+
+        fixed.append(new_c or c)
 
     logger.info("Fixed " + str(len(fixed)) + " configs")
     return fixed
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def new_body_hasher():
+    return hashlib.sha256()
+
+
+def body_hash(data):
+    hasher = new_body_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+class SourceCache:
+    """On-disk cache of source validators, body hashes and extracted configs.
+
+    A hit saves the download and the extraction; the extracted raw lines
+    are still parsed, so `hits` counts sources not re-extracted.
+    """
+
+    def __init__(self, path="cache/source_cache.json"):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        # Fetch threads count hits and misses concurrently
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.entries = data.get("sources", {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("Source cache unreadable, starting empty: " + str(e))
+            self.entries = {}
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def conditional_headers(self, url):
+        entry = self.entries.get(url)
+        headers = {}
+        if not entry:
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def lookup_hash(self, url, digest):
+        entry = self.entries.get(url)
+        if entry and entry.get("hash") == digest:
+            return entry.get("configs", [])
+        return None
+
+    def store(self, url, headers, digest, configs):
+        # A 304 may omit validators, so keep the previous ones in that case
+        old = self.entries.get(url, {})
+        self.entries[url] = {
+            "etag": headers.get("ETag", "") or old.get("etag", ""),
+            "last_modified": headers.get("Last-Modified", "") or old.get("last_modified", ""),
+            "hash": digest,
+            "configs": configs,
+        }
+
+    def prune(self, urls):
+        keep = set(urls)
+        for url in list(self.entries):
+            if url not in keep:
+                del self.entries[url]
+
+    def save(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"sources": self.entries}, f, ensure_ascii=False)
+        Path(tmp).replace(self.path)
+        logger.info("Source cache: " + str(self.hits) + " reused, " + str(self.misses) + " extracted")
@@ -1,14 +1,14 @@
-import socket
-import ssl
 import time
 import logging
-import base64
-import json
-import urllib.parse
-import copy
 import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from src.geoip import get_flag
+from src.resolver import get_resolver, group_by_endpoint
+from src.connect import race_connect
+from src.limits import abort_close, is_exhausted, probe_cap
+from src.tls import probe_context, get_session_cache
+from src.concurrency import (AIMDController, DestinationLimiter, ProcessFanout, interleave, partition, subnet_of,
+                             submit_adaptive)
 
 logger = logging.getLogger(__name__)
 
@@ -20,220 +20,367 @@ ALL_PORTS = TLS_PORTS + HTTP_PORTS
 # Target per port: ~40 configs
 TARGET_PER_PORT = 42
 
+# Bytes read by the default download test: enough to see a real response
+PROBE_BYTES = 1024
+# Connect and TLS handshake each give up after this long
+CONNECT_SECONDS = 4
+# A download stops after this long and is scored on what arrived
+DOWNLOAD_SECONDS = 10
+# Below this many bytes after the first read a bytes/s figure is noise
+MIN_THROUGHPUT_BYTES = 16 * 1024
+# Cloudflare's speed test, reachable on any Cloudflare edge IP; serves
+# exactly the requested number of bytes
+SPEED_HOST = "speed.cloudflare.com"
+SPEED_PATH = "/__down?bytes="
+# Speed downloads in flight at once: more and they share this host's link
+SPEED_WORKERS = 2
+
 
 def _resolve(config):
-    try:
-        if config.protocol == "vmess":
-            b64 = config.raw.replace("vmess://", "")
-            padding = 4 - len(b64) % 4
-            if padding != 4:
-                b64 += "=" * padding
-            try:
-                decoded = base64.b64decode(b64).decode("utf-8", errors="ignore")
-            except Exception:
-                decoded = base64.urlsafe_b64decode(b64).decode("utf-8", errors="ignore")
-            data = json.loads(decoded)
-            return data.get("add", ""), int(data.get("port", 0))
-        elif config.protocol in ["vless", "trojan"]:
-            parsed = urllib.parse.urlparse(config.raw)
-            return parsed.hostname or "", parsed.port or 0
-    except Exception:
-        pass
-    return config.address, config.port
+    return config.endpoint()
 
 
 def _get_sni(config):
-    try:
-        if config.protocol in ["vless", "trojan"]:
-            parsed = urllib.parse.urlparse(config.raw)
-            params = dict(urllib.parse.parse_qsl(parsed.query))
-            return params.get("sni", params.get("host", ""))
-        elif config.protocol == "vmess":
-            b64 = config.raw.replace("vmess://", "")
-            padding = 4 - len(b64) % 4
-            if padding != 4:
-                b64 += "=" * padding
-            decoded = base64.b64decode(b64).decode("utf-8", errors="ignore")
-            data = json.loads(decoded)
-            return data.get("sni", data.get("host", ""))
-    except Exception:
-        return ""
+    if config.protocol in ["vless", "trojan", "vmess"]:
+        return config.param("sni", config.param("host", ""))
+    return ""
 
 
 def _get_host(config):
-    try:
-        if config.protocol in ["vless", "trojan"]:
-            parsed = urllib.parse.urlparse(config.raw)
-            params = dict(urllib.parse.parse_qsl(parsed.query))
-            return params.get("host", parsed.hostname or "")
-        elif config.protocol == "vmess":
-            b64 = config.raw.replace("vmess://", "")
-            padding = 4 - len(b64) % 4
-            if padding != 4:
-                b64 += "=" * padding
-            decoded = base64.b64decode(b64).decode("utf-8", errors="ignore")
-            data = json.loads(decoded)
-            return data.get("host", data.get("add", ""))
-    except Exception:
-        return ""
-
-
-def download_test(config):
-    """Real download test through CDN"""
-    host, port = _resolve(config)
-    if not host or not port:
-        config.latency = -1
-        config.is_alive = False
-        return config
+    if config.protocol in ["vless", "trojan"]:
+        return config.param("host", config.fields.get("host", ""))
+    elif config.protocol == "vmess":
+        return config.param("host", config.param("add", ""))
+    return ""
+
 
+def _probe_names(config):
+    """(sni, Host header) the download test sends for this config"""
+    host, _ = _resolve(config)
     sni = _get_sni(config) or _get_host(config) or host
-    cdn_host = _get_host(config) or sni
+    return sni, _get_host(config) or sni
 
+
+def _stream(sock, size, seconds):
+    """Read up to size bytes into a preallocated buffer, for at most `seconds`.
+
+    Returns (bytes received, ms to the first byte, bytes/s after the first
+    read or -1 when too little arrived to tell).
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    start = time.perf_counter()
+    first_at = None
+    first_bytes = 0
     try:
-        # Step 1: TCP connect
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(4)
-        start = time.perf_counter()
-        sock.connect((host, port))
-        tcp_time = (time.perf_counter() - start) * 1000
-
-        # Step 2: TLS if needed
+        while received < size and time.perf_counter() - start < seconds:
+            n = sock.recv_into(view[received:])
+            if not n:
+                break
+            if first_at is None:
+                first_at = time.perf_counter()
+                first_bytes = n
+            received += n
+    except OSError:
+        pass
+    end = time.perf_counter()
+    if first_at is None:
+        return 0, -1, -1
+    ttfb = (first_at - start) * 1000
+    streamed = received - first_bytes
+    if streamed < MIN_THROUGHPUT_BYTES or end <= first_at:
+        return received, ttfb, -1
+    return received, ttfb, round(streamed / (end - first_at))
+
+
+def _fetch(addresses, port, sni, cdn_host, path, size):
+    """GET path through the first of addresses to connect and stream up to size bytes.
+
+    Returns (ip, tcp ms, tls ms, whether TLS resumed, bytes received, ms
+    to the first byte, bytes/s or -1); connect and handshake errors raise.
+    """
+    # Step 1: TCP connect, racing every A/AAAA address; the winner is kept
+    sock, ip, tcp_time = race_connect(addresses, port, CONNECT_SECONDS)
+    sock.setblocking(True)
+    sock.settimeout(CONNECT_SECONDS)
+    try:
+        # Step 2: TLS if needed, resuming an earlier session with this edge and SNI
+        sessions = get_session_cache()
+        tls_time = 0
+        resumed = False
         if port in TLS_PORTS:
-            ctx = ssl.create_default_context()
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
             tls_start = time.perf_counter()
-            sock = ctx.wrap_socket(sock, server_hostname=sni)
+            sock = probe_context().wrap_socket(sock, server_hostname=sni, session=sessions.get(ip, sni))
             tls_time = (time.perf_counter() - tls_start) * 1000
-        else:
-            tls_time = 0
+            resumed = sock.session_reused
+            sessions.record(tls_time, resumed)
 
-        # Step 3: HTTP request through socket
-        scheme = "https" if port in TLS_PORTS else "http"
-        http_req = "GET / HTTP/1.1\r\nHost: " + cdn_host + "\r\nUser-Agent: Mozilla/5.0\r\nConnection: close\r\n\r\n"
-
-        dl_start = time.perf_counter()
+        # Step 3: HTTP request through socket, response streamed into one buffer
+        http_req = ("GET " + path + " HTTP/1.1\r\nHost: " + cdn_host +
+                    "\r\nUser-Agent: Mozilla/5.0\r\nConnection: close\r\n\r\n")
         sock.sendall(http_req.encode())
+        received, ttfb, throughput = _stream(sock, size, DOWNLOAD_SECONDS)
+        if tls_time:
+            # TLS 1.3 tickets arrive after the handshake, so only now is there one to keep
+            sessions.put(ip, sni, sock.session)
+    finally:
+        abort_close(sock)
+    return ip, tcp_time, tls_time, resumed, received, ttfb, throughput
+
+
+def download_test(config, size=PROBE_BYTES):
+    """Real download test through CDN.
+
+    Streams up to `size` bytes with the config's own SNI and Host and
+    records time to first byte and sustained bytes/s separately.
+    """
+    config.ttfb_ms = config.throughput = config.tls_ms = config.tls_resumed_ms = -1
+    target, port = _resolve(config)
+    if not target or not port:
+        config.latency = -1
+        config.is_alive = False
+        return config
 
-        response = b""
-        while True:
-            try:
-                chunk = sock.recv(4096)
-                if not chunk:
-                    break
-                response += chunk
-                if len(response) > 1024:
-                    break
-            except Exception:
-                break
+    sni, cdn_host = _probe_names(config)
 
-        dl_time = (time.perf_counter() - dl_start) * 1000
-        sock.close()
+    addresses, config.dns_ms = get_resolver().lookup(target)
+    if not addresses:
+        config.latency = -1
+        config.is_alive = False
+        return config
+    config.ip = addresses[0]
 
-        total = round(tcp_time + tls_time + dl_time, 1)
+    try:
+        config.ip, tcp_time, tls_time, resumed, received, ttfb, throughput = \
+            _fetch(addresses, port, sni, cdn_host, "/", size)
+        if tls_time:
+            if resumed:
+                config.tls_resumed_ms = round(tcp_time + tls_time, 1)
+            else:
+                config.tls_ms = round(tcp_time + tls_time, 1)
 
         # Must get some response
-        if len(response) > 0:
-            config.latency = total
+        if received > 0:
+            config.latency = round(tcp_time + tls_time + ttfb, 1)
+            config.ttfb_ms = round(ttfb, 1)
+            config.throughput = throughput
             config.is_alive = True
         else:
             config.latency = -1
             config.is_alive = False
 
-    except Exception:
+    except Exception as e:
+        # Out of fds / ports here says nothing about the config
+        if is_exhausted(e):
+            raise
         config.latency = -1
         config.is_alive = False
 
     return config
 
 
-def test_cdn_batch(configs):
-    """Test CDN configs with real download"""
-    logger.info("CDN download testing " + str(len(configs)) + " configs...")
-    tested = []
-    alive = 0
-
-    with ThreadPoolExecutor(max_workers=100) as executor:
-        futures = {executor.submit(download_test, c): c for c in configs}
-        done = 0
-        for future in as_completed(futures):
-            done += 1
-            try:
-                result = future.result(timeout=15)
-                tested.append(result)
-                if result.is_alive:
-                    alive += 1
-            except Exception:
-                c = futures[future]
-                c.latency = -1
-                c.is_alive = False
-                tested.append(c)
-
-            if done % 200 == 0:
-                logger.info("  " + str(done) + "/" + str(len(configs)) + " alive:" + str(alive))
-
-    logger.info("CDN alive: " + str(alive) + "/" + str(len(configs)))
-    return tested
-
-
-def clone_vmess(raw, new_port, name):
+def speed_test(config, size):
+    """Bytes/s of `size` bytes from SPEED_HOST on the edge config reached.
+
+    Only sets config.throughput: the request carries SPEED_HOST, not the
+    config's names, so it says nothing about whether the config works.
+    """
+    config.throughput = -1
+    _, port = _resolve(config)
     try:
-        b64 = raw.replace("vmess://", "")
-        padding = 4 - len(b64) % 4
-        if padding != 4:
-            b64 += "=" * padding
-        try:
-            decoded = base64.b64decode(b64).decode("utf-8", errors="ignore")
-        except Exception:
-            decoded = base64.urlsafe_b64decode(b64).decode("utf-8", errors="ignore")
-        data = json.loads(decoded)
-        old_port = int(data.get("port", 0))
-
-        # TLS→TLS only, HTTP→HTTP only
-        if old_port in TLS_PORTS and new_port in HTTP_PORTS:
-            return None
-        if old_port in HTTP_PORTS and new_port in TLS_PORTS:
-            return None
-
-        data["port"] = new_port
-        data["ps"] = name
-        if new_port in TLS_PORTS:
-            data["tls"] = "tls"
-        else:
-            data["tls"] = ""
-        new_json = json.dumps(data, ensure_ascii=False)
-        return "vmess://" + base64.b64encode(new_json.encode("utf-8")).decode("utf-8")
-    except Exception:
+        config.throughput = _fetch([config.ip], port, SPEED_HOST, SPEED_HOST, SPEED_PATH + str(size), size)[-1]
+    except OSError:
+        pass
+    return config
+
+
+def _stop_at(deadline):
+    # A probe started later could still be connecting or downloading at the deadline
+    return deadline - CONNECT_SECONDS - DOWNLOAD_SECONDS if deadline is not None else None
+
+
+def _download_all(items, on_result, max_workers=100, size=PROBE_BYTES, stop_at=None):
+    """download_test(config, size) one representative per (key, config) item with adaptive concurrency.
+
+    Nothing new starts after the monotonic time stop_at; those items get no outcome.
+    """
+    # Spread probes over edges and cap how many hit one IP / /24 at once
+    controller = AIMDController(max_workers)
+    limiter = DestinationLimiter()
+    # Probes this host had no fd or port for get one more pass at the
+    # lower concurrency the controller backed off to, and otherwise no
+    # outcome at all: they say nothing about the config
+    for last in (False, True):
+        retry = []
+        ordered = interleave(items, lambda item: subnet_of(item[0][0][0]))
+        with ThreadPoolExecutor(max_workers=controller.maximum) as executor:
+            for (key, config), future in submit_adaptive(executor, lambda item: download_test(item[1], size),
+                                                         ordered, controller, limiter, lambda item: item[0][0],
+                                                         stop_at):
+                try:
+                    result = future.result()
+                    outcome = (result.latency, result.is_alive, result.ip, result.ttfb_ms, result.throughput,
+                               result.tls_ms, result.tls_resumed_ms)
+                except Exception as e:
+                    if is_exhausted(e):
+                        controller.observe(None)
+                        retry.append((key, config))
+                        continue
+                    outcome = (-1, False, config.ip, -1, -1, -1, -1)
+                controller.observe(outcome[0] if outcome[1] else None)
+                on_result(key, outcome)
+        if not retry:
+            break
+        logger.warning("CDN: " + str(len(retry)) + " probes ran out of fds / ports" +
+                       (", left without a verdict" if last else ", retrying them"))
+        items = retry
+    controller.report("CDN concurrency")
+    limiter.report()
+    get_session_cache().report("CDN TLS")
+
+
+def _download_partition(index, items, queue, max_workers, size, stop_at):
+    """Worker process body for test_cdn_batch(processes > 1)"""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [cdn " + str(index) + "] %(message)s",
+                        datefmt="%H:%M:%S")
+    _download_all(items, lambda key, outcome: queue.put((key, outcome)), max_workers, size, stop_at)
+
+
+def _speed_all(configs, size, stop_at=None):
+    """speed_test each alive TLS-port edge once, SPEED_WORKERS at a time.
+
+    Parallel multi-MB downloads from one host measure its own link rather
+    than the edge, so the fan-out used for liveness is not used here.
+    Nothing new starts after the monotonic time stop_at.
+    """
+    edges = {}
+    for c in configs:
+        if c.is_alive and c.port in TLS_PORTS:
+            edges.setdefault((c.ip, c.port), []).append(c)
+    # A plain-HTTP edge only redirects speed.cloudflare.com to https
+    logger.info("CDN speed testing " + str(len(edges)) + " TLS edges, " + str(SPEED_WORKERS) + " at a time...")
+    controller = AIMDController(SPEED_WORKERS, initial=SPEED_WORKERS, minimum=SPEED_WORKERS)
+    measured = 0
+    with ThreadPoolExecutor(max_workers=SPEED_WORKERS) as executor:
+        for key, future in submit_adaptive(executor, lambda key: speed_test(edges[key][0], size),
+                                           list(edges), controller, stop_at=stop_at):
+            throughput = future.result().throughput
+            for c in edges[key]:
+                c.throughput = throughput
+            measured += 1
+    if measured < len(edges):
+        logger.warning("CDN speed: out of time, " + str(len(edges) - measured) + " edges left unmeasured")
+
+
+def test_cdn_batch(configs, processes=1, max_workers=100, size=PROBE_BYTES, speed=False, deadline=None):
+    """Test CDN configs with real download.
+
+    speed=True then streams `size` bytes from SPEED_HOST on each alive
+    TLS edge, so configs can be ranked by throughput rather than time to
+    first byte; liveness still comes from the config's own SNI and Host.
+    No probe starts that could outlast the monotonic deadline; configs
+    left unprobed get no verdict (not alive, loss -1) rather than dead.
+    """
+    logger.info("CDN download testing " + str(len(configs)) + " configs...")
+    max_workers = probe_cap(max_workers, processes)
+    resolver = get_resolver()
+    resolver.resolve_all(_resolve(c)[0] for c in configs)
+
+    # Configs that hit the same ip:port with the same SNI and Host get the
+    # same answer, so only one of each group is downloaded through
+    groups, unresolved = group_by_endpoint(configs, resolver, _probe_names)
+    for c in unresolved:
+        c.latency = -1
+        c.is_alive = False
+    logger.info("  " + str(len(groups)) + " unique ip:port/sni/host probes")
+    items = [(key, group[0]) for key, group in groups.items()]
+    # The liveness pass only needs a response; `size` is for the speed pass
+    probe_size = PROBE_BYTES if speed else size
+    stop_at = _stop_at(deadline)
+    progress = {"done": 0, "alive": 0}
+    probed = set()
+
+    def on_result(key, outcome):
+        latency, is_alive, ip, ttfb_ms, throughput, tls_ms, tls_resumed_ms = outcome
+        probed.add(key)
+        for c in groups[key]:
+            c.latency = latency
+            c.is_alive = is_alive
+            if not is_alive:
+                c.loss = 1.0
+            c.ip = ip
+            c.ttfb_ms = ttfb_ms
+            c.throughput = throughput
+            c.tls_ms = tls_ms
+            c.tls_resumed_ms = tls_resumed_ms
+        progress["done"] += 1
+        if is_alive:
+            progress["alive"] += len(groups[key])
+        if progress["done"] % 200 == 0:
+            logger.info("  " + str(progress["done"]) + "/" + str(len(groups)) + " alive:" + str(progress["alive"]))
+
+    if processes > 1:
+        # Whole subnets go to one process so the politeness limits stay exact
+        partitions = partition(items, processes, lambda item: subnet_of(item[0][0][0]))
+        for key, outcome in ProcessFanout(_download_partition, partitions, max(max_workers // processes, 1),
+                                          probe_size, stop_at):
+            on_result(key, outcome)
+    else:
+        _download_all(items, on_result, max_workers, probe_size, stop_at)
+
+    # Cut off by the deadline, out of local fds / ports or lost with a
+    # worker process: unknown, not dead
+    unprobed = [key for key in groups if key not in probed]
+    for key in unprobed:
+        for c in groups[key]:
+            c.latency = c.ttfb_ms = c.throughput = c.tls_ms = c.tls_resumed_ms = c.loss = -1
+            c.is_alive = False
+    if unprobed:
+        logger.warning("CDN: " + str(len(unprobed)) + " probes left without a verdict")
+    logger.info("CDN alive: " + str(progress["alive"]) + "/" + str(len(configs)))
+    if speed:
+        _speed_all(configs, size, stop_at)
+    return list(configs)
+
+
+def clone_vmess(config, new_port, name):
+    _, old_port = config.endpoint()
+
+    # TLS→TLS only, HTTP→HTTP only
+    if old_port in TLS_PORTS and new_port in HTTP_PORTS:
+        return None
+    if old_port in HTTP_PORTS and new_port in TLS_PORTS:
         return None
 
+    return config.derive({
+        "port": new_port,
+        "ps": name,
+        "tls": "tls" if new_port in TLS_PORTS else "",
+    })
 
-def clone_vless(raw, new_port, name):
-    try:
-        parsed = urllib.parse.urlparse(raw)
-        old_port = parsed.port or 0
-        userinfo = parsed.username or ""
-        host = parsed.hostname
-        params = dict(urllib.parse.parse_qsl(parsed.query))
-
-        if old_port in TLS_PORTS and new_port in HTTP_PORTS:
-            return None
-        if old_port in HTTP_PORTS and new_port in TLS_PORTS:
-            return None
-
-        if new_port in TLS_PORTS:
-            params["security"] = "tls"
-            if not params.get("sni"):
-                params["sni"] = params.get("host", host)
-        else:
-            params["security"] = "none"
-            params.pop("sni", None)
 
-        query = urllib.parse.urlencode(params)
-        encoded_name = urllib.parse.quote(name, safe="")
-        return "vless://" + userinfo + "@" + host + ":" + str(new_port) + "?" + query + "#" + encoded_name
-    except Exception:
+def clone_vless(config, new_port, name):
+    if not config.fields:
+        return None
+    host, old_port = config.endpoint()
+
+    if old_port in TLS_PORTS and new_port in HTTP_PORTS:
+        return None
+    if old_port in HTTP_PORTS and new_port in TLS_PORTS:
         return None
 
+    params = {}
+    if new_port in TLS_PORTS:
+        params["security"] = "tls"
+        if not config.param("sni"):
+            params["sni"] = config.param("host", host)
+    else:
+        params["security"] = "none"
+        params["sni"] = None
+
+    return config.derive({"port": new_port, "name": name}, params)
+
 
 def generate_all_port_variants(configs):
     """Clone configs with ALL CDN ports"""
@@ -251,17 +398,13 @@ def generate_all_port_variants(configs):
             name = flag + " " + PREFIX + " p" + str(new_port) + "#" + str(counter)
 
             if c.protocol == "vmess":
-                new_raw = clone_vmess(c.raw, new_port, name)
+                new_c = clone_vmess(c, new_port, name)
             elif c.protocol == "vless":
-                new_raw = clone_vless(c.raw, new_port, name)
+                new_c = clone_vless(c, new_port, name)
             else:
                 continue
 
-            if new_raw:
-                new_c = copy.copy(c)
-                new_c.raw = new_raw
-                new_c.port = new_port
-                new_c.name = name
+            if new_c:
                 new_c.latency = -1
                 new_c.is_alive = False
                 variants.append(new_c)
@@ -270,8 +413,19 @@ def generate_all_port_variants(configs):
     return variants
 
 
-def balance_ports(configs, total=500):
-    """Balance configs across all ports, ~40 per port"""
+def _rank_key(rank):
+    if rank == "throughput":
+        # Fastest download first; configs without a figure after all that have one
+        return lambda x: (x.throughput < 0, -x.throughput, x.latency)
+    return lambda x: x.latency
+
+
+def balance_ports(configs, total=500, rank="latency"):
+    """Balance configs across all ports, ~40 per port.
+
+    rank="throughput" keeps the fastest downloads per port instead of the lowest latency.
+    """
+    key = _rank_key(rank)
     by_port = {}
     for c in configs:
         _, port = _resolve(c)
@@ -279,9 +433,9 @@ def balance_ports(configs, total=500):
             by_port[port] = []
         by_port[port].append(c)
 
-    # Sort each port group by latency
+    # Sort each port group best first
     for port in by_port:
-        by_port[port].sort(key=lambda x: x.latency)
+        by_port[port].sort(key=key)
 
     active_ports = len(by_port)
     if active_ports == 0:
@@ -297,7 +451,7 @@ def balance_ports(configs, total=500):
 
     # Fill remaining from best overall
     if len(result) < total:
-        all_sorted = sorted(configs, key=lambda x: x.latency)
+        all_sorted = sorted(configs, key=key)
         existing = set(c.raw for c in result)
         for c in all_sorted:
             if c.raw not in existing:
@@ -306,5 +460,5 @@ def balance_ports(configs, total=500):
             if len(result) >= total:
                 break
 
-    result.sort(key=lambda x: x.latency)
+    result.sort(key=key)
     return result[:total]
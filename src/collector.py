@@ -1,64 +1,297 @@
+import asyncio
 import json
 import logging
+import multiprocessing
+import os
+import sys
 import time
+import aiohttp
 import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from src.parser import parse_config, extract_configs_from_text
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from src.parser import parse_batch, ConfigStream
+from src.cache import SourceCache, new_body_hasher
+from src.ledger import SourceLedger
+from src.dedup import PayloadDedup
 
 logger = logging.getLogger(__name__)
 
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+CHUNK_SIZE = 65536
+# Seconds allowed for connecting and for each read; the whole body may
+# take longer, bounded only by the collector's deadline
+FETCH_TIMEOUT = 15
+# Raw lines per parse task handed to the process pool
+PARSE_BATCH = 2000
+
 
 class ConfigCollector:
-    def __init__(self, sources_file="sources.json"):
+    def __init__(self, sources_file="sources.json", cache_file="cache/source_cache.json",
+                 ledger_file="cache/source_ledger.json", mode="thread", per_host_limit=8, max_connections=64, deadline=60,
+                 parse_workers=None):
         self.sources_file = sources_file
+        self.cache = SourceCache(cache_file) if cache_file else None
+        self.ledger = SourceLedger(ledger_file) if ledger_file else None
+        self.dedup = PayloadDedup()
+        self.mode = mode
+        self.per_host_limit = per_host_limit
+        self.max_connections = max_connections
+        self.deadline = deadline
+        self.parse_workers = parse_workers if parse_workers is not None else (os.cpu_count() or 1)
         self.session = requests.Session()
-        self.session.headers.update({
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-        })
+        self.session.headers.update({"User-Agent": USER_AGENT})
 
     def _load_sources(self):
         with open(self.sources_file, "r") as f:
             data = json.load(f)
         return data.get("subscription_urls", [])
 
+    def _reuse_cached(self, url, headers):
+        entry = self.cache.get(url) if self.cache else None
+        if not entry:
+            return None
+        self.cache.store(url, headers, entry["hash"], entry["configs"])
+        self.cache.count(hit=True)
+        logger.info("  [=] " + str(len(entry["configs"])) + " cached from " + url.split("/")[-1])
+        return self._unless_duplicate(url, entry["hash"], entry["configs"])
+
+    def _unless_duplicate(self, url, digest, configs):
+        owner = self.dedup.claim_payload(url, digest, len(configs))
+        if owner:
+            logger.info("  [~] " + url.split("/")[-1] + " is identical to " + owner.split("/")[-1])
+            return []
+        return configs
+
+    def _duplicate_etag(self, url, headers):
+        cached = self.cache.get(url) if self.cache else None
+        owner = self.dedup.claim_etag(url, headers.get("ETag"), len(cached["configs"]) if cached else 0)
+        if owner:
+            logger.info("  [~] " + url.split("/")[-1] + " has the same ETag as " + owner.split("/")[-1])
+        return owner
+
+    def _finish_body(self, url, headers, digest, configs):
+        cached = self.cache.lookup_hash(url, digest) if self.cache else None
+        if cached is not None:
+            self.cache.store(url, headers, digest, cached)
+            self.cache.count(hit=True)
+            logger.info("  [=] " + str(len(cached)) + " unchanged from " + url.split("/")[-1])
+            return self._unless_duplicate(url, digest, cached)
+
+        if self.cache:
+            self.cache.store(url, headers, digest, configs)
+            self.cache.count(hit=False)
+        if configs:
+            logger.info("  [+] " + str(len(configs)) + " configs from " + url.split("/")[-1])
+        return self._unless_duplicate(url, digest, configs)
+
+    def _record_fetch(self, url, start, ok, configs=None):
+        if not ok:
+            self.dedup.release(url)
+        if self.ledger:
+            latency = (time.perf_counter() - start) * 1000
+            self.ledger.record_fetch(url, latency, ok, len(configs) if configs else 0)
+        return configs if ok else []
+
     def _fetch_url(self, url):
+        start = time.perf_counter()
         try:
-            resp = self.session.get(url, timeout=15)
-            resp.raise_for_status()
-            text = resp.text
-            configs = extract_configs_from_text(text)
-            if configs:
-                logger.info("  [+] " + str(len(configs)) + " configs from " + url.split("/")[-1])
-            return configs
+            headers = self.cache.conditional_headers(url) if self.cache else {}
+            with self.session.get(url, timeout=FETCH_TIMEOUT, headers=headers, stream=True) as resp:
+                if resp.status_code == 304:
+                    cached = self._reuse_cached(url, resp.headers)
+                    if cached is not None:
+                        return self._record_fetch(url, start, True, cached)
+                resp.raise_for_status()
+                if self._duplicate_etag(url, resp.headers):
+                    return self._record_fetch(url, start, True, [])
+                # Feed raw bytes straight to the extractor; resp.text would
+                # buffer the whole body and run charset detection over it
+                hasher = new_body_hasher()
+                stream = ConfigStream()
+                configs = []
+                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                    hasher.update(chunk)
+                    configs.extend(stream.feed(chunk))
+                configs.extend(stream.close())
+                configs = self._finish_body(url, resp.headers, hasher.hexdigest(), configs)
+                return self._record_fetch(url, start, True, configs)
         except Exception as e:
             logger.debug("  [-] Failed: " + url.split("/")[-1] + " | " + str(e))
-            return []
+            return self._record_fetch(url, start, False)
 
-    def collect_all(self):
-        urls = self._load_sources()
-        logger.info("Fetching from " + str(len(urls)) + " sources...")
+    async def _fetch_url_async(self, session, url):
+        start = time.perf_counter()
+        try:
+            headers = self.cache.conditional_headers(url) if self.cache else {}
+            async with session.get(url, headers=headers) as resp:
+                if resp.status == 304:
+                    cached = self._reuse_cached(url, resp.headers)
+                    if cached is not None:
+                        return self._record_fetch(url, start, True, cached)
+                resp.raise_for_status()
+                if self._duplicate_etag(url, resp.headers):
+                    return self._record_fetch(url, start, True, [])
+                hasher = new_body_hasher()
+                stream = ConfigStream()
+                configs = []
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    hasher.update(chunk)
+                    configs.extend(stream.feed(chunk))
+                configs.extend(stream.close())
+                configs = self._finish_body(url, resp.headers, hasher.hexdigest(), configs)
+                return self._record_fetch(url, start, True, configs)
+        except Exception as e:
+            logger.debug("  [-] Failed: " + url.split("/")[-1] + " | " + str(e))
+            return self._record_fetch(url, start, False)
 
-        all_configs = []
+    async def _fetch_tagged(self, session, url):
+        return url, await self._fetch_url_async(session, url)
 
+    def _collect_threaded(self, urls, on_source):
         with ThreadPoolExecutor(max_workers=20) as executor:
             futures = {executor.submit(self._fetch_url, url): url for url in urls}
             for future in as_completed(futures):
                 try:
-                    raw_configs = future.result(timeout=20)
-                    for raw in raw_configs:
-                        parsed = parse_config(raw)
-                        if parsed:
-                            all_configs.append(parsed)
+                    on_source(futures[future], future.result(timeout=20))
                 except Exception:
                     pass
 
-        # Remove duplicates
+    async def _collect_async(self, urls, on_source):
+        """Fetch every source concurrently over pooled keep-alive connections"""
+        connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                         limit_per_host=self.per_host_limit,
+                                         ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=FETCH_TIMEOUT, sock_read=FETCH_TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                         headers={"User-Agent": USER_AGENT}) as session:
+            tasks = [asyncio.ensure_future(self._fetch_tagged(session, url)) for url in urls]
+            try:
+                for next_done in asyncio.as_completed(tasks, timeout=self.deadline):
+                    url, raw_configs = await next_done
+                    on_source(url, raw_configs)
+            except asyncio.TimeoutError:
+                pending = [t for t in tasks if not t.done()]
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                logger.warning("Deadline hit: " + str(len(pending)) + " sources cancelled")
+
+    def collect_all(self):
+        all_urls = self._load_sources()
+        urls = all_urls
+        if self.ledger:
+            urls, _ = self.ledger.schedule(all_urls)
+        logger.info("Fetching from " + str(len(urls)) + " sources (" + self.mode + ")...")
+        start = time.perf_counter()
+        self.dedup = PayloadDedup()
+
+        # Each finished source is split into batches and parsed on the pool
+        # while the remaining sources are still downloading. Workers are
+        # spawned rather than forked since fetch threads are already running.
+        pool = None
+        if self.parse_workers > 1:
+            pool = ProcessPoolExecutor(max_workers=self.parse_workers,
+                                       mp_context=multiprocessing.get_context("spawn"))
+        batches = []
+        # Each config is credited to the highest-priority source carrying
+        # it, so a mirror family keeps one fetched member instead of all
+        # of them backing off together
+        rank = {url: i for i, url in enumerate(urls)}
+        owner = {}
+
+        def on_source(url, raw_configs):
+            for raw in raw_configs:
+                current = owner.get(raw)
+                if current is None or rank[url] < rank[current]:
+                    owner[raw] = url
+            # Line blocks another source already delivered are not re-parsed
+            raw_configs = self.dedup.split_blocks(url, raw_configs)
+            for i in range(0, len(raw_configs), PARSE_BATCH):
+                batch = raw_configs[i:i + PARSE_BATCH]
+                batches.append((url, pool.submit(parse_batch, batch) if pool else parse_batch(batch)))
+
+        try:
+            if self.mode == "async":
+                asyncio.run(self._collect_async(urls, on_source))
+            else:
+                self._collect_threaded(urls, on_source)
+            self._recover_orphans(rank, on_source)
+
+            # Identical payloads were parsed from whichever copy arrived
+            # first; credit them to the best-ranked source instead
+            aliases = self.dedup.resolve(rank)
+            for raw, url in owner.items():
+                owner[raw] = aliases.get(url, url)
+
+            all_configs = []
+            for url, batch in batches:
+                parsed = batch.result() if pool else batch
+                for c in parsed:
+                    c.source = aliases.get(url, url)
+                    # Re-intern after the trip through the worker process
+                    c.address = sys.intern(c.address)
+                all_configs.extend(parsed)
+        finally:
+            if pool:
+                pool.shutdown()
+
+        logger.info("Fetched and parsed in " + str(round(time.perf_counter() - start, 1)) + "s")
+        self.dedup.report()
+
+        if self.cache:
+            self.cache.prune(all_urls)
+            self.cache.save()
+        if self.ledger:
+            self._record_yield(urls, all_urls, owner)
+
+        # Remove duplicates: same server re-published under another remark,
+        # param order or vmess JSON encoding counts once
         seen = set()
         unique = []
         for c in all_configs:
-            if c.raw not in seen:
-                seen.add(c.raw)
+            if c.fingerprint not in seen:
+                seen.add(c.fingerprint)
                 unique.append(c)
 
         logger.info("Total unique configs: " + str(len(unique)))
         return unique
+
+    def _recover_orphans(self, rank, on_source):
+        """Parse the cached copy of ETag mirrors whose downloading source failed"""
+        for members in self.dedup.orphans():
+            for url in sorted(members, key=rank.get):
+                cached = self.cache.get(url) if self.cache else None
+                if cached:
+                    logger.info("  [=] " + str(len(cached["configs"])) + " cached from " + url.split("/")[-1] +
+                                ", its ETag twin failed")
+                    self.dedup.delivered[url] = len(cached["configs"])
+                    on_source(url, cached["configs"])
+                    break
+            else:
+                logger.warning("  [-] No copy of " + ", ".join(u.split("/")[-1] for u in members) +
+                               " after its ETag twin failed")
+
+    def _record_yield(self, urls, all_urls, owner):
+        credited = {}
+        for url in owner.values():
+            credited[url] = credited.get(url, 0) + 1
+        for url in urls:
+            self.ledger.record_unique(url, credited.get(url, 0), self.dedup.skipped.get(url, 0))
+        self.ledger.prune(all_urls)
+        self.ledger.save()
+
+    def record_alive(self, tested):
+        """Feed tester results back into the per-source ledger"""
+        if not self.ledger:
+            return
+        stats = {}
+        for c in tested:
+            # Never probed (history backoff, deadline, out of fds): no verdict
+            if not c.source or (not c.is_alive and c.loss < 0):
+                continue
+            counts = stats.setdefault(c.source, [0, 0])
+            counts[0] += 1
+            if c.is_alive:
+                counts[1] += 1
+        for url, (total, alive) in stats.items():
+            self.ledger.record_alive(url, total, alive)
+        self.ledger.save()
@@ -0,0 +1,388 @@
+import asyncio
+import ipaddress
+import logging
+import multiprocessing
+import queue as queue_module
+import statistics
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+logger = logging.getLogger(__name__)
+
+# Results per adjustment step
+WINDOW = 50
+# Cut when a window's median latency exceeds the baseline by this factor
+# and by at least INFLATION_MS (loopback-scale noise is not congestion)
+INFLATION = 2.0
+INFLATION_MS = 50
+# The baseline drops to any lower window median at once and rises this
+# share of the way towards each higher one: probes run best-first, so
+# later windows are slower without any congestion
+BASELINE_RISE = 0.3
+# ... or when its failure rate jumps this far above the running average
+FAILURE_JUMP = 0.3
+# Successes a window needs before its median latency is trusted
+MIN_SAMPLES = 5
+# Failure rate smoothing
+ALPHA = 0.3
+# Politeness towards shared CDN edges: in-flight probes per IP and per
+# /24, and new probes per second to one IP
+PER_IP = 8
+PER_SUBNET = 64
+PER_IP_RATE = 20
+# Queued items looked at when the head of the queue is blocked
+SCAN = 256
+
+
+class AIMDController:
+    """Additive-increase / multiplicative-decrease limit on in-flight probes.
+
+    Grows by `step` after every window of results whose latency and failure
+    rate look normal, and is multiplied by `decrease` after one that shows
+    congestion (inflated latency or a jump in timeouts/errors).
+    """
+
+    def __init__(self, maximum, initial=None, minimum=8, step=None, decrease=0.5, window=WINDOW):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.limit = max(self.minimum, min(initial or maximum // 4, maximum))
+        self.step = step or max(1, maximum // 20)
+        self.decrease = decrease
+        self.window = window
+        self._latencies = []
+        self._failures = 0
+        self._baseline_ms = None
+        self._failure_rate = None
+        # Results of probes started before the last cut still carry the old
+        # congestion, so they are not judged again (one cut per round trip)
+        self._hold = 0
+        self._start = time.perf_counter()
+        self.curve = [(0.0, self.limit)]
+
+    def observe(self, latency_ms):
+        """Feed one finished probe: its latency in ms, or None if it failed"""
+        if self._hold:
+            self._hold -= 1
+            return
+        if latency_ms is None:
+            self._failures += 1
+        else:
+            self._latencies.append(latency_ms)
+        if len(self._latencies) + self._failures >= self.window:
+            self._adjust()
+
+    def _adjust(self):
+        failure_rate = self._failures / (len(self._latencies) + self._failures)
+        inflated = False
+        if len(self._latencies) >= MIN_SAMPLES:
+            median = statistics.median(self._latencies)
+            if self._baseline_ms is None or median < self._baseline_ms:
+                self._baseline_ms = median
+            inflated = median > self._baseline_ms * INFLATION and median - self._baseline_ms > INFLATION_MS
+            self._baseline_ms += BASELINE_RISE * (median - self._baseline_ms)
+        jumped = self._failure_rate is not None and failure_rate > self._failure_rate + FAILURE_JUMP
+        self._failure_rate = failure_rate if self._failure_rate is None else \
+            self._failure_rate * (1 - ALPHA) + failure_rate * ALPHA
+        self._latencies = []
+        self._failures = 0
+
+        if inflated or jumped:
+            limit = max(self.minimum, int(self.limit * self.decrease))
+            self._hold = self.limit
+        else:
+            limit = min(self.maximum, self.limit + self.step)
+        if limit != self.limit:
+            self.limit = limit
+            self.curve.append((round(time.perf_counter() - self._start, 1), limit))
+
+    def report(self, label="Concurrency"):
+        points = self.curve
+        if len(points) > 24:
+            stride = len(points) / 24
+            points = [points[int(i * stride)] for i in range(24)] + [points[-1]]
+        logger.info(label + ": " + " ".join(str(limit) + "@" + str(t) + "s" for t, limit in points) +
+                    " (peak " + str(max(limit for _, limit in self.curve)) + ")")
+
+
+def subnet_of(ip):
+    """/24 for IPv4, /64 for IPv6"""
+    if ":" in ip:
+        return str(ipaddress.ip_network(ip + "/64", strict=False))
+    return ip.rsplit(".", 1)[0]
+
+
+def interleave(items, key, window=None):
+    """Round-robin items across key(item) groups, keeping each group's order.
+
+    Groups take turns in order of first appearance, so a run of configs on
+    one CDN edge is spread out instead of hitting it in one burst. With a
+    window, each slice of that many items is interleaved on its own so a
+    priority order of the input survives at that granularity.
+    """
+    items = list(items)
+    if window and len(items) > window:
+        return [item for i in range(0, len(items), window) for item in interleave(items[i:i + window], key)]
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), deque()).append(item)
+    queues = deque(groups.values())
+    result = []
+    while queues:
+        queue = queues.popleft()
+        result.append(queue.popleft())
+        if queue:
+            queues.append(queue)
+    return result
+
+
+def _subnets(ips):
+    return {subnet_of(ip) for ip in ips}
+
+
+class DestinationLimiter:
+    """Per-IP and per-subnet caps on in-flight probes plus a per-IP start rate.
+
+    A probe is charged to every address it may connect to, since a racing
+    connect can end up on any of them.
+    """
+
+    def __init__(self, per_ip=PER_IP, per_subnet=PER_SUBNET, per_ip_rate=PER_IP_RATE):
+        self.per_ip = per_ip
+        self.per_subnet = per_subnet
+        self.interval = 1.0 / per_ip_rate if per_ip_rate else 0.0
+        self._ip = {}
+        self._subnet = {}
+        self._next_start = {}
+        # ids of queued items already counted in `deferred`
+        self._held = set()
+        self.deferred = 0
+
+    def _delay(self, ips, now):
+        """0 if a probe to ips may start now, seconds to wait, or None if capped"""
+        if any(self._ip.get(ip, 0) >= self.per_ip for ip in ips) or \
+                any(self._subnet.get(subnet, 0) >= self.per_subnet for subnet in _subnets(ips)):
+            return None
+        return max(max(self._next_start.get(ip, 0.0) for ip in ips) - now, 0.0)
+
+    def take(self, queue, dest):
+        """Pop the first of the next SCAN items in queue whose destination is free.
+
+        Returns (item, None), or (None, seconds until a rate slot opens /
+        None if only a finishing probe can free one).
+        """
+        now = time.monotonic()
+        wait_s = None
+        for i in range(min(len(queue), SCAN)):
+            ips = dest(queue[i])
+            delay = self._delay(ips, now)
+            if delay == 0:
+                item = queue[i]
+                del queue[i]
+                self._held.discard(id(item))
+                for ip in set(ips):
+                    self._ip[ip] = self._ip.get(ip, 0) + 1
+                    self._next_start[ip] = now + self.interval
+                for subnet in _subnets(ips):
+                    self._subnet[subnet] = self._subnet.get(subnet, 0) + 1
+                return item, None
+            if id(queue[i]) not in self._held:
+                self._held.add(id(queue[i]))
+                self.deferred += 1
+            if delay is not None:
+                wait_s = delay if wait_s is None else min(wait_s, delay)
+        return None, wait_s
+
+    def release(self, ips):
+        for ip in set(ips):
+            self._ip[ip] -= 1
+        for subnet in _subnets(ips):
+            self._subnet[subnet] -= 1
+
+    def report(self):
+        if self.deferred:
+            logger.info("Politeness: " + str(self.deferred) + " probes held back for busy destinations")
+
+
+class _Unlimited:
+    def take(self, queue, dest):
+        return queue.popleft(), None
+
+    def release(self, ips):
+        pass
+
+
+def submit_adaptive(executor, fn, items, controller, limiter=None, dest=None, stop_at=None):
+    """Yield (item, future) as they finish, keeping controller.limit in flight.
+
+    With a limiter, dest(item) names every IP the item may connect to and
+    items with a saturated destination wait while later ones go ahead. The
+    caller should feed each result to controller.observe() before resuming
+    the generator so the next submissions see the new limit. Nothing new is
+    started after the monotonic time stop_at; unstarted items are dropped.
+    """
+    limiter = limiter or _Unlimited()
+    queue = deque(items)
+    inflight = {}
+    while True:
+        if stop_at is not None and queue and time.monotonic() >= stop_at:
+            queue.clear()
+        wait_s = None
+        while queue and len(inflight) < controller.limit:
+            item, wait_s = limiter.take(queue, dest)
+            if item is None:
+                break
+            inflight[executor.submit(fn, item)] = item
+        if not inflight:
+            if not queue:
+                return
+            time.sleep(wait_s or 0.01)
+            continue
+        done, _ = wait(inflight, timeout=wait_s, return_when=FIRST_COMPLETED)
+        for future in done:
+            item = inflight.pop(future)
+            limiter.release(dest(item) if dest else None)
+            yield item, future
+
+
+async def run_adaptive(coro_fn, items, controller, limiter=None, dest=None, stop_at=None):
+    """Async counterpart of submit_adaptive: yields (item, finished task)"""
+    limiter = limiter or _Unlimited()
+    queue = deque(items)
+    inflight = {}
+    while True:
+        if stop_at is not None and queue and time.monotonic() >= stop_at:
+            queue.clear()
+        wait_s = None
+        while queue and len(inflight) < controller.limit:
+            item, wait_s = limiter.take(queue, dest)
+            if item is None:
+                break
+            inflight[asyncio.ensure_future(coro_fn(item))] = item
+        if not inflight:
+            if not queue:
+                return
+            await asyncio.sleep(wait_s or 0.01)
+            continue
+        done, _ = await asyncio.wait(inflight, timeout=wait_s, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            item = inflight.pop(task)
+            limiter.release(dest(item) if dest else None)
+            yield item, task
+
+
+def partition(items, count, key):
+    """Split items into count lists so that all items sharing key(item) land in one.
+
+    Keeps per-destination limits exact when each list goes to its own
+    process, balances list sizes, and keeps the input order in each list.
+    """
+    groups = {}
+    for i, item in enumerate(items):
+        groups.setdefault(key(item), []).append((i, item))
+    parts = [[] for _ in range(count)]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(parts, key=len).extend(group)
+    return [[item for _, item in sorted(part, key=lambda x: x[0])] for part in parts]
+
+
+# Sentinel a worker process puts on the queue once its target returns or raises
+_DONE = "__done__"
+
+
+def _process_main(target, index, items, queue, args):
+    finished = False
+    try:
+        target(index, items, queue, *args)
+        finished = True
+    finally:
+        queue.put((_DONE, index, finished))
+
+
+class ProcessFanout:
+    """Run target(index, items, queue, *args) in one spawned process per partition.
+
+    Whatever the targets put on the queue is streamed back to the parent
+    as it arrives, through iteration or async iteration. The items of
+    partitions whose process raised or died are collected in `lost`; some
+    of them may still have had results streamed back.
+    """
+
+    def __init__(self, target, partitions, *args):
+        ctx = multiprocessing.get_context("spawn")
+        self.queue = ctx.Queue()
+        self.partitions = partitions
+        self.processes = {i: ctx.Process(target=_process_main, args=(target, i, items, self.queue, args),
+                                         daemon=True)
+                          for i, items in enumerate(partitions) if items}
+        for p in self.processes.values():
+            p.start()
+        self._running = set(self.processes)
+        self.lost = []
+
+    def _fail(self, index, reason):
+        logger.warning("Probe process " + str(index) + " " + reason + ", its " +
+                       str(len(self.partitions[index])) + " items may be incomplete")
+        self.lost.extend(self.partitions[index])
+
+    def _take(self, block):
+        item = self.queue.get(timeout=1) if block else self.queue.get_nowait()
+        if isinstance(item, tuple) and len(item) == 3 and item[0] == _DONE:
+            self._running.discard(item[1])
+            if not item[2]:
+                self._fail(item[1], "failed")
+            return None
+        return item
+
+    def _drain(self, batch):
+        """batch plus everything already queued"""
+        try:
+            while True:
+                item = self._take(False)
+                if item is not None:
+                    batch.append(item)
+        except queue_module.Empty:
+            pass
+        return batch
+
+    def _next(self):
+        """Next batch of items, everything already queued; [] once every process has finished"""
+        while self._running:
+            try:
+                item = self._take(True)
+            except queue_module.Empty:
+                exited = [i for i in self._running if self.processes[i].exitcode is not None]
+                if not exited:
+                    continue
+                # What an exited process queued before it went is still in
+                # the queue, and so may its done marker be
+                batch = self._drain([])
+                for i in exited:
+                    if i in self._running:
+                        self._running.discard(i)
+                        self._fail(i, "died with exit code " + str(self.processes[i].exitcode))
+                if batch:
+                    return batch
+                continue
+            batch = self._drain([] if item is None else [item])
+            if batch:
+                return batch
+        for p in self.processes.values():
+            p.join()
+        return []
+
+    def __iter__(self):
+        while True:
+            batch = self._next()
+            if not batch:
+                return
+            yield from batch
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await loop.run_in_executor(None, self._next)
+            if not batch:
+                return
+            for item in batch:
+                yield item
@@ -0,0 +1,122 @@
+import asyncio
+import errno
+import os
+import selectors
+import socket
+import time
+from src.limits import abort_close
+
+# Head start each address gets before the next one is tried as well
+# (RFC 8305 "Happy Eyeballs" connection attempt delay)
+STAGGER = 0.25
+
+_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+def _family(address):
+    return socket.AF_INET6 if ":" in address else socket.AF_INET
+
+
+def race_connect(addresses, port, timeout, stagger=STAGGER):
+    """Connect to whichever of addresses answers first.
+
+    Attempts start `stagger` seconds apart, or at once when the previous
+    one fails. Returns (sock, address, ms) with ms timed from that
+    address's own attempt; the socket is left non-blocking. Raises
+    socket.timeout if nothing answered in time, else the last OSError.
+    """
+    sel = selectors.DefaultSelector()
+    pending = list(addresses)
+    deadline = time.perf_counter() + timeout
+    next_start = 0.0
+    error = OSError(errno.EHOSTUNREACH, "no address to connect to")
+    try:
+        while True:
+            now = time.perf_counter()
+            if pending and (not sel.get_map() or now >= next_start):
+                address = pending.pop(0)
+                try:
+                    sock = socket.socket(_family(address), socket.SOCK_STREAM)
+                except OSError as e:
+                    error = e
+                    continue
+                sock.setblocking(False)
+                try:
+                    err = sock.connect_ex((address, port))
+                except OSError as e:
+                    err = e.errno or errno.EINVAL
+                if err not in _IN_PROGRESS:
+                    sock.close()
+                    error = OSError(err, os.strerror(err))
+                    continue
+                sel.register(sock, selectors.EVENT_WRITE, (address, now))
+                next_start = now + stagger
+                continue
+            if not sel.get_map():
+                raise error
+            if now >= deadline:
+                raise socket.timeout("timed out")
+            wait_s = deadline - now
+            if pending:
+                wait_s = min(wait_s, next_start - now)
+            for key, _ in sel.select(max(wait_s, 0)):
+                sock = key.fileobj
+                address, start = key.data
+                sel.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    return sock, address, (time.perf_counter() - start) * 1000
+                sock.close()
+                error = OSError(err, os.strerror(err))
+                next_start = 0.0
+    finally:
+        # Attempts still in flight lost the race
+        for key in list(sel.get_map().values()):
+            abort_close(key.fileobj)
+        sel.close()
+
+
+async def race_connect_async(addresses, port, timeout, stagger=STAGGER):
+    """Event-loop version of race_connect with the same result and errors"""
+    loop = asyncio.get_running_loop()
+    pending = list(addresses)
+    attempts = {}
+    deadline = loop.time() + timeout
+    error = OSError(errno.EHOSTUNREACH, "no address to connect to")
+
+    def start(address):
+        sock = socket.socket(_family(address), socket.SOCK_STREAM)
+        sock.setblocking(False)
+        task = asyncio.ensure_future(loop.sock_connect(sock, (address, port)))
+        attempts[task] = (sock, address, time.perf_counter())
+
+    try:
+        while True:
+            if pending:
+                try:
+                    start(pending.pop(0))
+                except OSError as e:
+                    error = e
+                    continue
+            if not attempts:
+                raise error
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            done, _ = await asyncio.wait(attempts, timeout=min(stagger, remaining) if pending else remaining,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                sock, address, started = attempts.pop(task)
+                if task.exception() is None:
+                    return sock, address, (time.perf_counter() - started) * 1000
+                sock.close()
+                error = task.exception()
+    finally:
+        # The loop drops a cancelled connect's writer for its fd only on a
+        # later iteration; closing first lets the next probe's socket reuse
+        # the fd and lose its own writer to that cleanup
+        for task in attempts:
+            task.cancel()
+        await asyncio.gather(*attempts, return_exceptions=True)
+        for sock, _, _ in attempts.values():
+            abort_close(sock)
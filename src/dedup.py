@@ -0,0 +1,138 @@
+import hashlib
+import logging
+import threading
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# Content-defined block boundaries: a line whose hash has these low bits
+# clear ends a block, so shifted copies of the same lines still produce
+# the same blocks (average block is BLOCK_MASK + 1 lines)
+BLOCK_MASK = 31
+
+
+class PayloadDedup:
+    """Skip parsing of payloads and line blocks already seen this run.
+
+    Whichever source of an identical payload or ETag arrives first is the
+    one parsed, but credit goes to the best-ranked one: resolve() settles
+    that once every fetch has finished.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (host, etag) -> {"fetching": url downloading the body, "members": {url: lines}}
+        self._etags = {}
+        # body digest -> {url: lines}
+        self._payloads = {}
+        self._blocks = set()
+        # Sources whose body arrived in full, with its line count
+        self.delivered = {}
+        self.skipped = {}
+
+    def record_skip(self, url, count):
+        with self._lock:
+            self.skipped[url] = self.skipped.get(url, 0) + count
+
+    def claim_etag(self, url, etag, count=0):
+        """Return the source already downloading this ETag on the same host, if any.
+
+        count is the line count url had last time, used if it is skipped.
+        """
+        if not etag or etag.startswith("W/"):
+            return None
+        key = (urllib.parse.urlparse(url).hostname, etag)
+        with self._lock:
+            group = self._etags.setdefault(key, {"fetching": None, "members": {}})
+            group["members"][url] = count
+            if group["fetching"] is None:
+                group["fetching"] = url
+                return None
+            return group["fetching"]
+
+    def claim_payload(self, url, digest, count):
+        """Return the source that already delivered this exact body, if any"""
+        with self._lock:
+            self.delivered[url] = count
+            group = self._payloads.setdefault(digest, {})
+            owner = next(iter(group), url)
+            group[url] = count
+        return owner if owner != url else None
+
+    def release(self, url):
+        """Drop url's ETag claims after its fetch failed, so a later mirror downloads instead"""
+        with self._lock:
+            for group in self._etags.values():
+                if group["fetching"] == url:
+                    group["fetching"] = None
+                group["members"].pop(url, None)
+
+    def orphans(self):
+        """Sources skipped for an ETag whose downloading source never delivered"""
+        with self._lock:
+            return [[u for u in group["members"] if u != group["fetching"]]
+                    for group in self._etags.values()
+                    if group["fetching"] not in self.delivered and group["members"]]
+
+    def resolve(self, rank):
+        """Credit each identical payload / ETag group to its best-ranked source.
+
+        Returns {url: owner} for every source whose content is credited to
+        another; those are counted as skipped.
+        """
+        with self._lock:
+            groups = [dict(g) for g in self._payloads.values()]
+            for group in self._etags.values():
+                groups.append({u: self.delivered.get(u, count) for u, count in group["members"].items()})
+        aliases = {}
+        for members in groups:
+            if len(members) < 2:
+                continue
+            best = min(members, key=lambda u: rank.get(u, len(rank)))
+            for url, count in members.items():
+                if url != best and url not in aliases:
+                    aliases[url] = best
+                    self.record_skip(url, count)
+        # A source can sit in an ETag group and a payload group at once
+        for url in aliases:
+            seen = {url}
+            while aliases[url] in aliases and aliases[url] not in seen:
+                seen.add(aliases[url])
+                aliases[url] = aliases[aliases[url]]
+        return aliases
+
+    def split_blocks(self, url, lines):
+        """Return only the lines of blocks no earlier source contained"""
+        fresh = []
+        block = []
+        for line in lines:
+            block.append(line)
+            if hash(line) & BLOCK_MASK == 0:
+                self._take_block(url, block, fresh)
+                block = []
+        if block:
+            self._take_block(url, block, fresh)
+        return fresh
+
+    def _take_block(self, url, block, fresh):
+        # A digest, not hash(): a collision would drop real lines as redundant
+        h = hashlib.blake2b(digest_size=16)
+        for line in block:
+            h.update(line.encode("utf-8"))
+            h.update(b"\n")
+        key = h.digest()
+        with self._lock:
+            seen = key in self._blocks
+            self._blocks.add(key)
+        if seen:
+            self.record_skip(url, len(block))
+        else:
+            fresh.extend(block)
+
+    def report(self):
+        total = sum(self.skipped.values())
+        if not total:
+            return
+        for url, count in sorted(self.skipped.items(), key=lambda x: -x[1]):
+            logger.info("  [~] " + str(count) + " redundant lines skipped from " + url.split("/")[-1])
+        logger.info("Redundant lines not parsed: " + str(total))
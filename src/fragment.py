@@ -1,7 +1,3 @@
-import base64
-import json
-import urllib.parse
-import copy
 import logging
 from src.geoip import get_flag
 
@@ -16,50 +12,24 @@ FRAGMENT_SETTINGS = [
 ]
 
 
-def add_fragment_vmess(raw, fragment, name):
-    try:
-        b64 = raw.replace("vmess://", "")
-        padding = 4 - len(b64) % 4
-        if padding != 4:
-            b64 += "=" * padding
-        try:
-            decoded = base64.b64decode(b64).decode("utf-8", errors="ignore")
-        except Exception:
-            decoded = base64.urlsafe_b64decode(b64).decode("utf-8", errors="ignore")
-        data = json.loads(decoded)
-
-        port = int(data.get("port", 0))
-        if port not in [443, 8443, 2053, 2083, 2087, 2096]:
-            return None
-
-        data["ps"] = name
-        new_json = json.dumps(data, ensure_ascii=False)
-        return "vmess://" + base64.b64encode(new_json.encode("utf-8")).decode("utf-8")
-    except Exception:
+def add_fragment_vmess(config, fragment, name):
+    _, port = config.endpoint()
+    if port not in [443, 8443, 2053, 2083, 2087, 2096]:
         return None
+    return config.derive({"ps": name})
 
 
-def add_fragment_vless(raw, fragment, name):
-    try:
-        parsed = urllib.parse.urlparse(raw)
-        params = dict(urllib.parse.parse_qsl(parsed.query))
-
-        port = parsed.port or 0
-        if port not in [443, 8443, 2053, 2083, 2087, 2096]:
-            return None
-
-        security = params.get("security", "")
-        if security != "tls" and security != "reality":
-            return None
+def add_fragment_vless(config, fragment, name):
+    _, port = config.endpoint()
+    if port not in [443, 8443, 2053, 2083, 2087, 2096]:
+        return None
 
-        if "#" in raw:
-            base_part = raw.rsplit("#", 1)[0]
-        else:
-            base_part = raw
-        return base_part + "#" + urllib.parse.quote(name, safe="")
-    except Exception:
+    security = config.param("security", "")
+    if security != "tls" and security != "reality":
         return None
 
+    return config.renamed(name)
+
 
 def generate_fragment_configs(configs):
     if not configs:
@@ -73,16 +43,13 @@ def generate_fragment_configs(configs):
         name = flag + " " + PREFIX + " frag#" + str(i + 1)
 
         if c.protocol == "vmess":
-            new_raw = add_fragment_vmess(c.raw, frag, name)
+            new_c = add_fragment_vmess(c, frag, name)
         elif c.protocol == "vless":
-            new_raw = add_fragment_vless(c.raw, frag, name)
+            new_c = add_fragment_vless(c, frag, name)
         else:
             continue
 
-        if new_raw:
-            new_c = copy.copy(c)
-            new_c.raw = new_raw
-            new_c.name = name
+        if new_c:
             result.append(new_c)
 
     logger.info("Fragment configs: " + str(len(result)))
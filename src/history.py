@@ -0,0 +1,162 @@
+import logging
+import sqlite3
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# A dead endpoint is next probed 2^(streak-1) runs later, capped here
+MAX_BACKOFF_RUNS = 32
+# Smoothing for latency / success averages
+ALPHA = 0.3
+# Below this success ratio an endpoint is probed after everything else
+FLAKY_RATIO = 0.5
+# Endpoints not seen for this many runs are forgotten
+MAX_IDLE_RUNS = 64
+
+COLUMNS = ("runs", "alive_runs", "ewma_ms", "success", "fail_streak", "skip_until", "last_run")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS endpoints (
+    endpoint TEXT PRIMARY KEY,
+    runs INTEGER NOT NULL,
+    alive_runs INTEGER NOT NULL,
+    ewma_ms REAL,
+    success REAL,
+    fail_streak INTEGER NOT NULL,
+    skip_until INTEGER NOT NULL,
+    last_run INTEGER NOT NULL
+);
+"""
+
+
+def _ewma(old, new, digits):
+    if old is None:
+        return new
+    return round(old * (1 - ALPHA) + new * ALPHA, digits)
+
+
+def endpoint_key(ip, port):
+    return ("[" + ip + "]" if ":" in ip else ip) + ":" + str(port)
+
+
+class LatencyHistory:
+    """Per-endpoint latency and liveness history kept across runs in SQLite"""
+
+    def __init__(self, path="cache/history.db"):
+        self.path = path
+        self.run = 0
+        self.endpoints = {}
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self._load()
+
+    def _load(self):
+        try:
+            self.db.executescript(SCHEMA)
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'run'").fetchone()
+            self.run = row[0] if row else 0
+            for row in self.db.execute("SELECT endpoint, " + ", ".join(COLUMNS) + " FROM endpoints"):
+                self.endpoints[row[0]] = dict(zip(COLUMNS, row[1:]))
+        except sqlite3.Error as e:
+            logger.warning("Latency history unreadable, starting empty: " + str(e))
+            self.db.close()
+            Path(self.path).unlink(missing_ok=True)
+            self.db = sqlite3.connect(self.path)
+            self.db.executescript(SCHEMA)
+
+    def _priority(self, endpoint):
+        e = self.endpoints.get(endpoint)
+        if not e or e["success"] is None:
+            return 1, 0.0
+        if e["success"] < FLAKY_RATIO:
+            return 2, -e["success"]
+        return 0, e["ewma_ms"] or 0.0
+
+    def _in_backoff(self, endpoint):
+        e = self.endpoints.get(endpoint)
+        return bool(e) and e["skip_until"] >= self.run
+
+    def plan(self, targets, keys):
+        """Start a run; return (targets to probe, targets in backoff).
+
+        keys(target) gives the endpoint keys of every address a target can
+        be reached on; it is in backoff only when all of them are, and is
+        ranked by its best one. Targets to probe come known-good first,
+        then unseen, then flaky.
+        """
+        self.run += 1
+        due, skipped = [], []
+        for target in targets:
+            endpoints = keys(target)
+            if all(self._in_backoff(e) for e in endpoints):
+                skipped.append(target)
+            else:
+                due.append((min(self._priority(e) for e in endpoints), target))
+        due.sort(key=lambda x: x[0])
+        due = [target for _, target in due]
+        if skipped:
+            logger.info("History: skipping " + str(len(skipped)) + " dead endpoints in backoff")
+        return due, skipped
+
+    def record(self, results):
+        """Fold one run's {endpoint: latency ms or None} into the history"""
+        for endpoint, latency in results.items():
+            e = self.endpoints.get(endpoint)
+            if e is None:
+                e = self.endpoints[endpoint] = {
+                    "runs": 0, "alive_runs": 0, "ewma_ms": None, "success": None,
+                    "fail_streak": 0, "skip_until": 0, "last_run": 0,
+                }
+            e["runs"] += 1
+            e["last_run"] = self.run
+            if latency is not None:
+                e["alive_runs"] += 1
+                e["ewma_ms"] = _ewma(e["ewma_ms"], round(latency, 1), 1)
+                e["success"] = _ewma(e["success"], 1.0, 3)
+                e["fail_streak"] = 0
+            else:
+                e["success"] = _ewma(e["success"], 0.0, 3)
+                e["fail_streak"] += 1
+                e["skip_until"] = self.run + min(2 ** (e["fail_streak"] - 1), MAX_BACKOFF_RUNS) - 1
+
+    def success(self, endpoint):
+        """Smoothed share of runs the endpoint was alive in, or None if never probed"""
+        e = self.endpoints.get(endpoint)
+        return e["success"] if e else None
+
+    def stability(self, endpoint, latency):
+        """Smoothed latency inflated by the historical failure rate; lower is better"""
+        e = self.endpoints.get(endpoint)
+        if not e or e["ewma_ms"] is None:
+            return latency
+        return e["ewma_ms"] / max(e["success"], 0.05)
+
+    def merge(self, others):
+        """Fold in histories written by shard runs that started from the same state.
+
+        Each shard probed a disjoint set of configs in the same run; a row
+        one of them updated in that run replaces ours, preferring one that
+        found the endpoint alive when several shards reached it.
+        """
+        for other in others:
+            for endpoint, e in other.endpoints.items():
+                mine = self.endpoints.get(endpoint)
+                if mine is None or (e["last_run"], e["alive_runs"]) > (mine["last_run"], mine["alive_runs"]):
+                    self.endpoints[endpoint] = dict(e)
+            self.run = max(self.run, other.run)
+        logger.info("History: merged " + str(len(others)) + " shard histories, " +
+                    str(len(self.endpoints)) + " endpoints")
+
+    def prune(self):
+        for endpoint in list(self.endpoints):
+            if self.run - self.endpoints[endpoint]["last_run"] > MAX_IDLE_RUNS:
+                del self.endpoints[endpoint]
+
+    def save(self):
+        self.prune()
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('run', ?)", (self.run,))
+            self.db.execute("DELETE FROM endpoints")
+            self.db.executemany("INSERT INTO endpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(k,) + tuple(e[c] for c in COLUMNS) for k, e in self.endpoints.items()])
@@ -0,0 +1,122 @@
+import json
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# A failing source is next tried 2^(streak-1) runs later, capped here
+MAX_BACKOFF_RUNS = 32
+# After this many runs without a single new config a source is
+# treated as a pure mirror and only fetched every DUPLICATE_INTERVAL runs
+DUPLICATE_RUNS = 3
+DUPLICATE_INTERVAL = 4
+# Smoothing for latency / yield / alive averages
+ALPHA = 0.3
+
+
+def _ewma(old, new):
+    if old is None:
+        return new
+    return round(old * (1 - ALPHA) + new * ALPHA, 3)
+
+
+class SourceLedger:
+    """Persistent per-source fetch health and yield statistics"""
+
+    def __init__(self, path="cache/source_ledger.json"):
+        self.path = path
+        self.run = 0
+        self.sources = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.run = data.get("run", 0)
+            self.sources = data.get("sources", {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("Source ledger unreadable, starting empty: " + str(e))
+
+    def _entry(self, url):
+        if url not in self.sources:
+            self.sources[url] = {
+                "fetches": 0, "failures": 0, "fail_streak": 0, "latency_ms": None,
+                "total": 0, "unique_new": None, "dup_streak": 0, "skipped_lines": 0,
+                "tested": 0, "alive": 0, "alive_ratio": None, "skip_until": 0,
+            }
+        return self.sources[url]
+
+    def score(self, url):
+        e = self.sources.get(url)
+        if not e or e["unique_new"] is None:
+            # Never measured: fetch early so it gets a score
+            return float("inf")
+        alive_ratio = self.alive_ratio(url)
+        return e["unique_new"] * (0.5 + alive_ratio) / (1 + e["fail_streak"])
+
+    def alive_ratio(self, url, default=0.5):
+        e = self.sources.get(url)
+        if not e or e["alive_ratio"] is None:
+            return default
+        return e["alive_ratio"]
+
+    def schedule(self, urls):
+        """Return (urls to fetch ordered by expected yield, skipped urls)"""
+        self.run += 1
+        due, skipped = [], []
+        for url in urls:
+            e = self.sources.get(url)
+            if e and e["skip_until"] >= self.run:
+                skipped.append(url)
+            else:
+                due.append(url)
+        due.sort(key=self.score, reverse=True)
+        if skipped:
+            logger.info("Ledger: skipping " + str(len(skipped)) + " backed-off / mirror sources")
+        return due, skipped
+
+    def record_fetch(self, url, latency_ms, ok, count=0):
+        e = self._entry(url)
+        e["fetches"] += 1
+        e["latency_ms"] = _ewma(e["latency_ms"], round(latency_ms, 1))
+        if ok:
+            e["fail_streak"] = 0
+            e["total"] = count
+        else:
+            e["failures"] += 1
+            e["fail_streak"] += 1
+            e["skip_until"] = self.run + min(2 ** (e["fail_streak"] - 1), MAX_BACKOFF_RUNS) - 1
+
+    def record_unique(self, url, unique_new, skipped_lines=0):
+        e = self._entry(url)
+        if e["fail_streak"]:
+            return
+        e["skipped_lines"] = skipped_lines
+        e["unique_new"] = _ewma(e["unique_new"], unique_new)
+        e["dup_streak"] = e["dup_streak"] + 1 if unique_new == 0 else 0
+        if e["dup_streak"] >= DUPLICATE_RUNS:
+            e["skip_until"] = self.run + DUPLICATE_INTERVAL - 1
+
+    def record_alive(self, url, tested, alive):
+        if not tested:
+            return
+        e = self._entry(url)
+        e["tested"] = tested
+        e["alive"] = alive
+        e["alive_ratio"] = _ewma(e["alive_ratio"], round(alive / tested, 3))
+
+    def prune(self, urls):
+        keep = set(urls)
+        for url in list(self.sources):
+            if url not in keep:
+                del self.sources[url]
+
+    def save(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"run": self.run, "sources": self.sources}, f, indent=1)
+        Path(tmp).replace(self.path)
@@ -0,0 +1,87 @@
+import errno
+import logging
+import socket
+import struct
+
+try:
+    import resource
+except ImportError:  # Windows has no rlimits
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Errors that mean this host ran out of descriptors, ports or buffers: the
+# probe never reached the target, so they say nothing about the config
+EXHAUSTION_ERRNOS = frozenset((errno.EMFILE, errno.ENFILE, errno.EADDRNOTAVAIL, errno.ENOBUFS))
+# Descriptors kept free for logging, DNS, the history db, pipes, ...
+RESERVE_FDS = 128
+# A racing connect can hold more than one socket while its attempts overlap
+SOCKETS_PER_PROBE = 2
+# Never ask for more than this even when the hard limit is unlimited
+MAX_FDS = 1 << 20
+# Linux default net.ipv4.ip_local_port_range when it cannot be read
+DEFAULT_PORTS = 60999 - 32768 + 1
+
+# SO_LINGER on with a zero timeout: close() sends RST and frees the port at
+# once instead of leaving it in TIME_WAIT for a minute
+_ABORT = struct.pack("ii", 1, 0)
+
+
+def is_exhausted(error):
+    return isinstance(error, OSError) and error.errno in EXHAUSTION_ERRNOS
+
+
+def set_abortive(sock):
+    """Make the next close() of sock reset the connection instead of lingering in TIME_WAIT"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _ABORT)
+    except (OSError, AttributeError):
+        pass
+
+
+def abort_close(sock):
+    set_abortive(sock)
+    sock.close()
+
+
+def fd_limit():
+    if resource is None:
+        return MAX_FDS
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    return MAX_FDS if soft == resource.RLIM_INFINITY else soft
+
+
+def raise_fd_limit():
+    """Raise the soft RLIMIT_NOFILE to the hard limit; returns the soft limit in effect"""
+    if resource is None:
+        return fd_limit()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = MAX_FDS if hard == resource.RLIM_INFINITY else hard
+    if soft != resource.RLIM_INFINITY and soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            logger.info("Raised open file limit from " + str(soft) + " to " + str(target))
+        except (ValueError, OSError) as e:
+            logger.warning("Could not raise open file limit " + str(soft) + ": " + str(e))
+    return fd_limit()
+
+
+def port_range():
+    """Number of local ephemeral ports outgoing connects can use"""
+    try:
+        with open("/proc/sys/net/ipv4/ip_local_port_range", "r") as f:
+            low, high = (int(x) for x in f.read().split())
+        return high - low + 1
+    except (OSError, ValueError):
+        return DEFAULT_PORTS
+
+
+def probe_cap(limit, processes=1):
+    """limit, lowered so `processes` processes running that many probes in total
+    stay within each process's fd limit and the host's shared ephemeral ports"""
+    fds = (raise_fd_limit() - RESERVE_FDS) * processes
+    cap = max(min(limit, fds // SOCKETS_PER_PROBE, port_range() // SOCKETS_PER_PROBE), 1)
+    if cap < limit:
+        logger.warning("In-flight probes capped at " + str(cap) + " (of " + str(limit) +
+                       ") by the fd / ephemeral port budget")
+    return cap
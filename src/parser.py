@@ -1,18 +1,133 @@
 import base64
+import hashlib
 import json
 import re
+import sys
 import urllib.parse
 
 
 class ProxyConfig:
-    def __init__(self, raw, protocol, address="", port=0, name=""):
+    # Slots instead of a per-instance __dict__: at 100k+ configs the
+    # object overhead is most of the collector's memory
+    __slots__ = ("raw", "protocol", "address", "port", "name", "latency", "is_alive",
+                 "source", "fingerprint", "ip", "dns_ms", "p50", "p90", "jitter", "loss", "tls_ms",
+                 "tls_resumed_ms", "ttfb_ms", "throughput", "_fields")
+
+    def __init__(self, raw, protocol, address="", port=0, name="", fingerprint=b""):
         self.raw = raw
-        self.protocol = protocol
-        self.address = address
+        self.protocol = sys.intern(protocol)
+        self.address = sys.intern(str(address)) if address else ""
         self.port = port
         self.name = name
         self.latency = -1
         self.is_alive = False
+        self.source = ""
+        # Identity of the server ignoring remark and param order; see fingerprint()
+        self.fingerprint = fingerprint or _digest(raw)
+        # Address the tester actually connected to, and its lookup time
+        self.ip = ""
+        self.dns_ms = -1
+        # Connect time spread over the tester's samples; -1 until measured.
+        # A dead config has loss 1.0, so loss -1 also marks one never probed
+        self.p50 = -1
+        self.p90 = -1
+        self.jitter = -1
+        self.loss = -1
+        # Connect + TLS handshake time with the config's SNI; -1 if not checked
+        self.tls_ms = -1
+        # The same when the handshake resumed an earlier session instead
+        self.tls_resumed_ms = -1
+        # CDN download test: time to first response byte and sustained bytes/s
+        self.ttfb_ms = -1
+        self.throughput = -1
+        self._fields = None
+
+    @property
+    def fields(self):
+        """Decoded structure of raw, decoded once and cached.
+
+        vmess: the JSON object. vless/trojan: user, host, port, params, name.
+        ss: method, password, host, port, name. Treat it as read-only and use
+        derive() to change anything.
+        """
+        if self._fields is None:
+            self._fields = decode_fields(self.protocol, self.raw) or {}
+        return self._fields
+
+    def endpoint(self):
+        # address/port are set from the decoded fields at parse time and kept
+        # in sync by derive(), so probing never has to decode anything
+        return self.address, self.port
+
+    def param(self, key, default=""):
+        """Transport/TLS setting: vmess JSON key or vless/trojan query param"""
+        if self.protocol == "vmess":
+            return self.fields.get(key, default)
+        return self.fields.get("params", {}).get(key, default)
+
+    def derive(self, changes=None, params=None):
+        """Copy with some fields changed, or None if raw could not be decoded.
+
+        A value of None removes the key. raw is re-encoded only if something
+        actually differs, and a remark-only change on a URI just swaps the
+        #fragment so the rest of the original URI is kept byte for byte.
+        """
+        if not changes and not params:
+            return self._clone()
+        fields = self.fields
+        if not fields:
+            return None
+        new = dict(fields)
+        dirty = set()
+        for key, value in (changes or {}).items():
+            if value is None:
+                if key in new:
+                    del new[key]
+                    dirty.add(key)
+            elif key not in new or new[key] != value:
+                new[key] = value
+                dirty.add(key)
+        if params:
+            new_params = dict(new.get("params", {}))
+            for key, value in params.items():
+                if value is None:
+                    if key in new_params:
+                        del new_params[key]
+                        dirty.add("params")
+                elif new_params.get(key) != value:
+                    new_params[key] = value
+                    dirty.add("params")
+            new["params"] = new_params
+
+        c = self._clone()
+        if not dirty:
+            return c
+        c._fields = new
+        name_key = "ps" if self.protocol == "vmess" else "name"
+        if dirty == {name_key} and self.protocol != "vmess":
+            base = self.raw.rsplit("#", 1)[0] if "#" in self.raw else self.raw
+            c.raw = base + "#" + urllib.parse.quote(new[name_key], safe="")
+        else:
+            c.raw = encode_fields(self.protocol, new)
+        c.name = new.get(name_key, "")
+        if dirty - {name_key}:
+            try:
+                address, port = _fields_endpoint(self.protocol, new)
+                c.address, c.port = sys.intern(str(address)), int(port)
+                c.fingerprint = config_fingerprint(self.protocol, new)
+            except Exception:
+                c.fingerprint = _digest(c.raw)
+        return c
+
+    def _clone(self):
+        # Shares every string and the decoded fields with the original
+        c = ProxyConfig.__new__(ProxyConfig)
+        for slot in ProxyConfig.__slots__:
+            setattr(c, slot, getattr(self, slot))
+        return c
+
+    def renamed(self, name):
+        return self.derive({"ps" if self.protocol == "vmess" else "name": name})
 
 
 def safe_b64decode(data):
@@ -29,84 +144,177 @@ def safe_b64decode(data):
         return ""
 
 
-def parse_vmess(config_str):
-    try:
-        raw = config_str.strip()
-        b64_part = raw.replace("vmess://", "")
-        decoded = safe_b64decode(b64_part)
-        if not decoded:
+def _b64encode(text):
+    return base64.b64encode(text.encode("utf-8")).decode("utf-8")
+
+
+def _decode_ss(raw):
+    main_part = raw.replace("ss://", "")
+    name = ""
+    if "#" in main_part:
+        main_part, name = main_part.rsplit("#", 1)
+        name = urllib.parse.unquote(name)
+
+    if "@" in main_part:
+        creds, server = main_part.split("@", 1)
+    else:
+        decoded = safe_b64decode(main_part)
+        if not decoded or "@" not in decoded:
             return None
-        data = json.loads(decoded)
-        return ProxyConfig(
-            raw=raw, protocol="vmess",
-            address=data.get("add", ""),
-            port=int(data.get("port", 0)),
-            name=data.get("ps", "")
-        )
-    except Exception:
-        return None
+        creds, server = decoded.split("@", 1)
+    host, port = server.rsplit(":", 1)
+    # Bare like urlparse().hostname; encode_fields adds the brackets back
+    host = host.strip("[]")
 
+    userinfo = urllib.parse.unquote(creds)
+    creds = userinfo if ":" in userinfo else safe_b64decode(userinfo)
+    method, sep, password = creds.partition(":")
+    fields = {"method": method, "password": password, "host": host, "port": int(port), "name": name}
+    if not sep:
+        # Undecodable credentials are kept as they came, so re-encoding and
+        # the fingerprint still tell such configs apart
+        fields["userinfo"] = userinfo
+    return fields
 
-def parse_vless(config_str):
+
+def decode_fields(protocol, raw):
     try:
-        raw = config_str.strip()
-        parsed = urllib.parse.urlparse(raw)
-        return ProxyConfig(
-            raw=raw, protocol="vless",
-            address=parsed.hostname or "",
-            port=parsed.port or 0,
-            name=urllib.parse.unquote(parsed.fragment) if parsed.fragment else ""
-        )
+        raw = raw.strip()
+        if protocol == "vmess":
+            decoded = safe_b64decode(raw.replace("vmess://", ""))
+            data = json.loads(decoded) if decoded else None
+            return data if isinstance(data, dict) else None
+        if protocol in ["vless", "trojan"]:
+            parsed = urllib.parse.urlparse(raw)
+            return {
+                "user": parsed.username or "",
+                "host": parsed.hostname or "",
+                "port": parsed.port or 0,
+                "params": dict(urllib.parse.parse_qsl(parsed.query)),
+                "name": urllib.parse.unquote(parsed.fragment) if parsed.fragment else "",
+            }
+        if protocol == "ss":
+            return _decode_ss(raw)
     except Exception:
-        return None
+        pass
+    return None
 
 
-def parse_trojan(config_str):
-    try:
-        raw = config_str.strip()
-        parsed = urllib.parse.urlparse(raw)
-        return ProxyConfig(
-            raw=raw, protocol="trojan",
-            address=parsed.hostname or "",
-            port=parsed.port or 0,
-            name=urllib.parse.unquote(parsed.fragment) if parsed.fragment else ""
+def encode_fields(protocol, fields):
+    if protocol == "vmess":
+        return "vmess://" + _b64encode(json.dumps(fields, ensure_ascii=False))
+    host = fields["host"]
+    if ":" in host:
+        host = "[" + host + "]"
+    server = host + ":" + str(fields["port"])
+    name = "#" + urllib.parse.quote(fields.get("name", ""), safe="")
+    if protocol == "ss":
+        creds = fields.get("userinfo") or _b64encode(fields["method"] + ":" + fields["password"])
+        return "ss://" + creds + "@" + server + name
+    query = urllib.parse.urlencode(fields.get("params", {}))
+    return protocol + "://" + fields["user"] + "@" + server + ("?" + query if query else "") + name
+
+
+def _fields_endpoint(protocol, fields):
+    if protocol == "vmess":
+        return fields.get("add", ""), fields.get("port", 0)
+    return fields["host"], fields["port"]
+
+
+def _digest(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def _norm(value):
+    return urllib.parse.unquote(str(value or "")).strip()
+
+
+def _norm_host(value):
+    return _norm(value).strip("[]").rstrip(".").lower()
+
+
+def fingerprint(protocol, secret, host, port, transport="", path="", header_host="",
+                sni="", security="", extra=""):
+    """Canonical server identity shared by re-published copies of a config.
+
+    Returned as a 16-byte digest so 100k configs don't each carry a second
+    copy of their settings.
+    """
+    return _digest("|".join([
+        protocol, _norm(secret), _norm_host(host), str(int(port or 0)),
+        _norm(transport).lower() or "tcp", _norm(path), _norm_host(header_host),
+        _norm_host(sni), _norm(security).lower(), extra,
+    ]))
+
+
+def config_fingerprint(protocol, fields):
+    if protocol == "vmess":
+        f = fields
+        return fingerprint(
+            "vmess", str(f.get("id", "")).lower(), f.get("add", ""), f.get("port", 0),
+            f.get("net", ""), f.get("path", ""), f.get("host", ""),
+            f.get("sni", ""), f.get("tls", ""), _norm(f.get("type", "")),
         )
-    except Exception:
-        return None
+    if protocol == "ss":
+        secret = fields["method"] + ":" + fields["password"]
+        if "userinfo" in fields:
+            secret = _digest(fields["userinfo"]).hex()
+        return fingerprint("ss", secret, fields["host"], fields["port"])
 
+    params = fields["params"]
+    secret = urllib.parse.unquote(fields["user"])
+    if protocol == "vless":
+        # UUIDs are case-insensitive, trojan passwords are not
+        secret = secret.lower()
+    transport = params.get("type", "tcp")
+    path = params.get("serviceName", "") if transport == "grpc" else params.get("path", "")
+    extra = ",".join(_norm(params.get(k, "")) for k in ["flow", "pbk", "sid"])
+    if protocol == "vless":
+        # Absent means none, the only value most clients accept today
+        extra += "," + (_norm(params.get("encryption", "")).lower() or "none")
+    default_security = "tls" if protocol == "trojan" else "none"
+    return fingerprint(
+        protocol, secret, fields["host"], fields["port"],
+        transport, path, params.get("host", ""), params.get("sni", ""),
+        params.get("security", default_security), extra,
+    )
 
-def parse_ss(config_str):
+
+def _parse(protocol, config_str):
     try:
         raw = config_str.strip()
-        main_part = raw.replace("ss://", "")
-        name = ""
-        if "#" in main_part:
-            main_part, name = main_part.rsplit("#", 1)
-            name = urllib.parse.unquote(name)
-
-        if "@" in main_part:
-            creds, server = main_part.split("@", 1)
-            host, port = server.rsplit(":", 1)
-            port = int(port)
-        else:
-            decoded = safe_b64decode(main_part)
-            if not decoded:
-                return None
-            if "@" in decoded:
-                creds, server = decoded.split("@", 1)
-                host, port = server.rsplit(":", 1)
-                port = int(port)
-            else:
-                return None
-
+        fields = decode_fields(protocol, raw)
+        if not fields:
+            return None
+        address, port = _fields_endpoint(protocol, fields)
+        # fields is dropped here: configs stay small to keep and to pickle
+        # back from the parse pool, and .fields decodes again on demand
         return ProxyConfig(
-            raw=raw, protocol="ss",
-            address=host, port=port, name=name
+            raw=raw, protocol=protocol,
+            address=address, port=int(port),
+            name=fields.get("ps" if protocol == "vmess" else "name", ""),
+            fingerprint=config_fingerprint(protocol, fields)
         )
     except Exception:
         return None
 
 
+def parse_vmess(config_str):
+    return _parse("vmess", config_str)
+
+
+def parse_vless(config_str):
+    return _parse("vless", config_str)
+
+
+def parse_trojan(config_str):
+    return _parse("trojan", config_str)
+
+
+def parse_ss(config_str):
+    return _parse("ss", config_str)
+
+
 def parse_config(config_str):
     config_str = config_str.strip()
     if config_str.startswith("vmess://"):
@@ -120,31 +328,140 @@ def parse_config(config_str):
     return None
 
 
-def extract_configs_from_text(text):
+def parse_batch(lines):
     configs = []
+    for line in lines:
+        parsed = parse_config(line)
+        if parsed:
+            configs.append(parsed)
+    return configs
+
+
+PREFIXES = ["vmess://", "vless://", "trojan://", "ss://"]
+_B64_ALPHABET = frozenset(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=-_")
+_WHITESPACE = b" \t\r\n"
+_URLSAFE = bytes.maketrans(b"-_", b"+/")
+
+# How much of the body to look at before deciding plain vs base64
+SNIFF_BYTES = 1024
+# A "line" longer than this is cut at its last whitespace to bound memory
+MAX_LINE = 65536
+
 
+_CONFIG_PATTERN = r"(?:vmess|vless|trojan|ss)://[A-Za-z0-9+/=_\-%.@:?&#!,;\[\]()~]+"
+_CONFIG_RE = re.compile(_CONFIG_PATTERN)
+_CONFIG_RE_BYTES = re.compile(_CONFIG_PATTERN.encode())
+
+
+def iter_configs(text, seen=None):
+    """Yield each config URI in text (str or bytes) once, in order, in one sweep.
+
+    A URI that starts its line is also yielded as the whole stripped line, so
+    remarks with characters outside the URI alphabet survive intact.
+    """
+    if seen is None:
+        seen = set()
+    is_bytes = isinstance(text, bytes)
+    regex, newline = (_CONFIG_RE_BYTES, b"\n") if is_bytes else (_CONFIG_RE, "\n")
+    # Text before `scanned` has been looked at once; `blank` says whether
+    # the current line is whitespace only up to there. Re-scanning from the
+    # line start for every match is quadratic on long one-line payloads.
+    scanned = 0
+    blank = True
+    for m in regex.finditer(text):
+        start, end = m.span()
+        found = [m.group()]
+        newline_at = text.rfind(newline, scanned, start)
+        if newline_at != -1:
+            blank = not text[newline_at + 1:start].strip()
+        else:
+            blank = blank and not text[scanned:start].strip()
+        scanned = start
+        if blank:
+            line_end = text.find(newline, end)
+            line = text[start:line_end if line_end != -1 else len(text)].rstrip()
+            if len(line) != end - start:
+                found.insert(0, line)
+        for c in found:
+            if is_bytes:
+                c = c.decode("utf-8", errors="ignore")
+            if c not in seen:
+                seen.add(c)
+                yield c
+
+
+class ConfigStream:
+    """Incremental config extractor fed with raw response bytes"""
+
+    def __init__(self):
+        self.mode = None
+        self._head = b""
+        self._b64_carry = b""
+        self._line_carry = b""
+        self._seen = set()
+
+    def _sniff(self, final=False):
+        sample = self._head.translate(None, _WHITESPACE)
+        if len(sample) < SNIFF_BYTES and not final:
+            return False
+        self.mode = "plain"
+        if sample and b"://" not in sample and all(b in _B64_ALPHABET for b in sample):
+            usable = sample if final else sample[:len(sample) // 4 * 4]
+            if b"://" in _b64decode_bytes(usable):
+                self.mode = "b64"
+        return True
+
+    def _decode(self, chunk, final=False):
+        if self.mode != "b64":
+            return chunk
+        data = self._b64_carry + chunk.translate(None, _WHITESPACE)
+        if final:
+            self._b64_carry = b""
+            return _b64decode_bytes(data)
+        cut = len(data) // 4 * 4
+        self._b64_carry = data[cut:]
+        return _b64decode_bytes(data[:cut])
+
+    def _split_lines(self, data, final=False):
+        # Scan every complete line in one sweep and carry the partial tail
+        buf = self._line_carry + data
+        cut = len(buf) if final else buf.rfind(b"\n") + 1
+        if len(buf) - cut > MAX_LINE:
+            space = max(buf.rfind(b" "), buf.rfind(b"\t"))
+            cut = space + 1 if space >= cut else len(buf)
+        self._line_carry = buf[cut:]
+        return list(iter_configs(buf[:cut], self._seen))
+
+    def feed(self, chunk):
+        if self.mode is None:
+            self._head += chunk
+            if not self._sniff():
+                return []
+            chunk, self._head = self._head, b""
+        return self._split_lines(self._decode(chunk))
+
+    def close(self):
+        if self.mode is None:
+            self._sniff(final=True)
+            chunk, self._head = self._head, b""
+        else:
+            chunk = b""
+        return self._split_lines(self._decode(chunk, final=True), final=True)
+
+
+def _b64decode_bytes(data):
+    try:
+        data = data.translate(_URLSAFE)
+        padding = 4 - len(data) % 4
+        if padding != 4:
+            data += b"=" * padding
+        return base64.b64decode(data)
+    except Exception:
+        return b""
+
+
+def extract_configs_from_text(text):
     decoded = safe_b64decode(text)
-    if decoded and any(p in decoded for p in ["vmess://", "vless://", "trojan://", "ss://"]):
+    if decoded and any(p in decoded for p in PREFIXES):
         text = decoded
-
-    for line in text.splitlines():
-        line = line.strip()
-        for prefix in ["vmess://", "vless://", "trojan://", "ss://"]:
-            if line.startswith(prefix):
-                configs.append(line)
-                break
-
-    for protocol in ["vmess://", "vless://", "trojan://", "ss://"]:
-        escaped = re.escape(protocol)
-        pattern = escaped + r'[A-Za-z0-9+/=_\-%.@:?&#!,;\[\]()~]+'
-        matches = re.findall(pattern, text)
-        configs.extend(matches)
-
-    seen = set()
-    unique = []
-    for c in configs:
-        if c not in seen:
-            seen.add(c)
-            unique.append(c)
-
-    return unique
+    return list(iter_configs(text))
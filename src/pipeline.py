@@ -0,0 +1,209 @@
+import asyncio
+import base64
+import logging
+import os
+import time
+from src.limits import is_exhausted, set_abortive
+from src.tls import probe_context
+
+logger = logging.getLogger(__name__)
+
+# Transports whose server answers a plain HTTP upgrade we can check
+UPGRADE_TRANSPORTS = ("ws", "httpupgrade")
+
+
+def _uses_tls(config):
+    if config.protocol == "vmess":
+        return config.param("tls") == "tls"
+    if config.protocol == "trojan":
+        return config.param("security", "tls") != "none"
+    if config.protocol == "vless":
+        return config.param("security") in ("tls", "reality", "xtls")
+    return False
+
+
+def _sni(config):
+    return config.param("sni") or config.param("host") or config.address
+
+
+def _close(writer):
+    set_abortive(writer.get_extra_info("socket"))
+    writer.transport.abort()
+
+
+def _transport(config):
+    if config.protocol == "vmess":
+        return config.param("net", "tcp") or "tcp"
+    return config.param("type", "tcp") or "tcp"
+
+
+class ProbePipeline:
+    """TCP gate, then TLS handshake, then transport check, each on the previous stage's survivors.
+
+    Every stage has its own worker count and timeout and starts as soon as
+    the previous one hands over a survivor, so deep checks cost only as
+    much as the alive set. Identical checks (same ip, port, SNI, ...)
+    run once and are shared.
+    """
+
+    def __init__(self, tester, tls_timeout=4, tls_concurrency=200, transport_timeout=5, transport_concurrency=100):
+        self.tester = tester
+        self.tls_timeout = tls_timeout
+        self.tls_concurrency = tls_concurrency
+        self.transport_timeout = transport_timeout
+        self.transport_concurrency = transport_concurrency
+        self.ssl_context = probe_context(["http/1.1"])
+        self._checks = {}
+        self.counts = {}
+        self.skipped = 0
+        self.exhausted = 0
+        self.deadline = None
+
+    def run(self, configs, deadline=None):
+        return asyncio.run(self.run_async(configs, deadline))
+
+    async def run_async(self, configs, deadline=None):
+        """Run all stages; checks that could outlast the monotonic deadline are
+        skipped and the config keeps its verdict from the earlier stages"""
+        self._checks = {}
+        self.counts = {"tls": [0, 0], "transport": [0, 0]}
+        self.skipped = 0
+        self.exhausted = 0
+        tls_queue = asyncio.Queue()
+        transport_queue = asyncio.Queue()
+        self.deadline = deadline
+        tls_workers = [asyncio.ensure_future(self._worker(tls_queue, self._tls_stage, transport_queue))
+                       for _ in range(self.tls_concurrency)]
+        transport_workers = [asyncio.ensure_future(self._worker(transport_queue, self._transport_stage))
+                             for _ in range(self.transport_concurrency)]
+
+        def on_alive(group):
+            for c in group:
+                tls_queue.put_nowait(c)
+
+        tested = await self.tester.test_batch_async(configs, on_alive, deadline)
+        for queue, workers in ((tls_queue, tls_workers), (transport_queue, transport_workers)):
+            for _ in workers:
+                queue.put_nowait(None)
+            await asyncio.gather(*workers)
+
+        for stage, (checked, passed) in self.counts.items():
+            logger.info("Stage " + stage + ": " + str(passed) + "/" + str(checked) + " passed")
+        if self.skipped:
+            logger.warning("Deadline: " + str(self.skipped) + " later-stage checks skipped")
+        if self.exhausted:
+            logger.warning("Resources: " + str(self.exhausted) + " later-stage checks skipped for lack of fds / ports")
+        logger.info("Pipeline alive: " + str(sum(1 for c in tested if c.is_alive)) + "/" + str(len(tested)))
+        return tested
+
+    async def _worker(self, queue, check, next_queue=None):
+        while True:
+            c = await queue.get()
+            if c is None:
+                return
+            try:
+                ok = await check(c)
+            except Exception:
+                ok = False
+            if not ok:
+                c.latency = -1
+                c.is_alive = False
+            elif next_queue is not None:
+                next_queue.put_nowait(c)
+
+    def _out_of_time(self, timeout):
+        if self.deadline and time.monotonic() + timeout > self.deadline:
+            self.skipped += 1
+            return True
+        return False
+
+    def _unchecked(self, error):
+        # Out of fds / ports: the check never ran, so the config keeps the
+        # earlier stages' verdict like one skipped for the deadline
+        if not is_exhausted(error):
+            raise error
+        self.exhausted += 1
+        return True
+
+    async def _shared(self, key, factory):
+        task = self._checks.get(key)
+        if task is None:
+            task = self._checks[key] = asyncio.ensure_future(factory())
+        return await task
+
+    async def _open(self, ip, port, sni, timeout):
+        ssl_context = self.ssl_context if sni is not None else None
+        return await asyncio.wait_for(
+            asyncio.open_connection(ip, port, ssl=ssl_context, server_hostname=sni),
+            timeout)
+
+    async def _handshake(self, ip, port, sni):
+        """Connect + TLS handshake time in ms, or None"""
+        start = time.perf_counter()
+        try:
+            _, writer = await self._open(ip, port, sni, self.tls_timeout)
+        except Exception as e:
+            if is_exhausted(e):
+                raise
+            return None
+        ms = round((time.perf_counter() - start) * 1000, 1)
+        _close(writer)
+        return ms
+
+    async def _upgrade(self, ip, port, sni, path, host):
+        """True if the server switches protocols on a WebSocket upgrade for path"""
+        try:
+            reader, writer = await self._open(ip, port, sni, self.transport_timeout)
+        except Exception as e:
+            if is_exhausted(e):
+                raise
+            return False
+        try:
+            key = base64.b64encode(os.urandom(16)).decode()
+            writer.write(("GET " + path + " HTTP/1.1\r\nHost: " + host + "\r\nUser-Agent: Mozilla/5.0\r\n"
+                          "Upgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: " + key +
+                          "\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+            await writer.drain()
+            status = await asyncio.wait_for(reader.readline(), self.transport_timeout)
+            return status.split(b" ")[1:2] == [b"101"]
+        except Exception:
+            return False
+        finally:
+            _close(writer)
+
+    async def _tls_stage(self, c):
+        if not _uses_tls(c) or self._out_of_time(self.tls_timeout):
+            return True
+        counts = self.counts["tls"]
+        sni = _sni(c)
+        try:
+            c.tls_ms = await self._shared(("tls", c.ip, c.port, sni), lambda: self._handshake(c.ip, c.port, sni))
+        except OSError as e:
+            return self._unchecked(e)
+        counts[0] += 1
+        if c.tls_ms is None:
+            c.tls_ms = -1
+            return False
+        counts[1] += 1
+        return True
+
+    async def _transport_stage(self, c):
+        # Only HTTP-upgrade transports can be checked without speaking the
+        # proxy protocol itself; the rest keep their TCP/TLS verdict
+        if _transport(c) not in UPGRADE_TRANSPORTS or self._out_of_time(self.transport_timeout):
+            return True
+        counts = self.counts["transport"]
+        sni = _sni(c) if _uses_tls(c) else None
+        path = c.param("path", "/") or "/"
+        if not path.startswith("/"):
+            path = "/" + path
+        host = (c.param("host") or _sni(c)).split(",")[0]
+        try:
+            ok = await self._shared(("transport", c.ip, c.port, sni, path, host),
+                                    lambda: self._upgrade(c.ip, c.port, sni, path, host))
+        except OSError as e:
+            return self._unchecked(e)
+        counts[0] += 1
+        if ok:
+            counts[1] += 1
+        return ok
@@ -0,0 +1,124 @@
+import ipaddress
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Failed lookups are remembered for a shorter time than answers
+NEGATIVE_TTL = 60
+
+
+def is_ip(host):
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def interleave_families(addresses):
+    """Alternate address families, starting with the system's preferred one (RFC 8305)"""
+    addresses = list(addresses)
+    if not addresses:
+        return addresses
+    first_v6 = ":" in addresses[0]
+    same = [a for a in addresses if (":" in a) == first_v6]
+    other = [a for a in addresses if (":" in a) != first_v6]
+    result = []
+    for i in range(max(len(same), len(other))):
+        result.extend(group[i] for group in (same, other) if i < len(group))
+    return result
+
+
+class Resolver:
+    """Resolve each hostname once per run on a bounded pool and cache it"""
+
+    def __init__(self, ttl=300, max_workers=64):
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _query(self, host):
+        start = time.perf_counter()
+        try:
+            infos = socket.getaddrinfo(host, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
+            addresses = interleave_families(dict.fromkeys(info[4][0] for info in infos))
+        except Exception:
+            addresses = []
+        dns_ms = round((time.perf_counter() - start) * 1000, 1)
+        ttl = self.ttl if addresses else NEGATIVE_TTL
+        entry = (addresses, dns_ms, time.monotonic() + ttl)
+        with self._lock:
+            self._cache[host] = entry
+        return entry
+
+    def _cached(self, host):
+        with self._lock:
+            entry = self._cache.get(host)
+        if entry and entry[2] > time.monotonic():
+            return entry
+        return None
+
+    def resolve_all(self, hosts):
+        """Resolve every unique hostname not already cached, concurrently"""
+        pending = [h for h in set(hosts) if h and not is_ip(h) and not self._cached(h)]
+        if not pending:
+            return
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as executor:
+            results = list(executor.map(self._query, pending))
+        failed = sum(1 for addresses, _, _ in results if not addresses)
+        logger.info("Resolved " + str(len(pending)) + " hostnames in " +
+                    str(round(time.perf_counter() - start, 1)) + "s (" + str(failed) + " failed)")
+
+    def lookup(self, host):
+        """Return (addresses, dns_ms); resolves on the spot if not cached"""
+        if not host:
+            return [], 0.0
+        if is_ip(host):
+            return [host], 0.0
+        entry = self._cached(host) or self._query(host)
+        return entry[0], entry[1]
+
+    def first(self, host):
+        addresses, _ = self.lookup(host)
+        return addresses[0] if addresses else None
+
+
+def group_by_endpoint(configs, resolver=None, extra=None):
+    """Group configs by resolved (addresses, port), plus extra(config) if given.
+
+    Returns (groups, unresolved); addresses is the tuple of every A/AAAA
+    answer so probes can race them. Configs sharing a key only need one
+    probe whose result is fanned out to the whole group. Sets ip (first
+    address until a probe picks the winner) and dns_ms on each.
+    """
+    resolver = resolver or get_resolver()
+    groups = {}
+    unresolved = []
+    for c in configs:
+        host, port = c.endpoint()
+        addresses, c.dns_ms = resolver.lookup(host)
+        if not host or not port or not addresses:
+            unresolved.append(c)
+            continue
+        c.ip = addresses[0]
+        addresses = tuple(addresses)
+        key = (addresses, port) if extra is None else (addresses, port, extra(c))
+        groups.setdefault(key, []).append(c)
+    return groups, unresolved
+
+
+_shared = None
+
+
+def get_resolver():
+    """Process-wide resolver so all testers in a run share one cache"""
+    global _shared
+    if _shared is None:
+        _shared = Resolver()
+    return _shared
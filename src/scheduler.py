@@ -0,0 +1,42 @@
+import logging
+import time
+from src.history import endpoint_key
+
+logger = logging.getLogger(__name__)
+
+# Rough share of alive configs per protocol, used until a source or
+# endpoint has history of its own
+PROTOCOL_PRIOR = {"vless": 0.5, "trojan": 0.45, "vmess": 0.4, "ss": 0.3}
+# Weight of the endpoint's own success ratio once it has one
+HISTORY_WEIGHT = 0.75
+
+
+class RunBudget:
+    """Wall-clock budget of one run, so testing ends in time for the output stages"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.start = time.monotonic()
+
+    def remaining(self):
+        return self.start + self.seconds - time.monotonic()
+
+    def deadline(self, reserve=0):
+        """Monotonic time a stage must finish by to leave `reserve` seconds for the rest"""
+        return self.start + self.seconds - reserve
+
+    def log(self, stage):
+        logger.info(stage + ": " + str(round(time.monotonic() - self.start)) + "s used, " +
+                    str(round(self.remaining())) + "s left")
+
+
+def prior_score(config, history=None, ledger=None):
+    """Estimated chance the config is alive, from endpoint history, source yield and protocol"""
+    score = PROTOCOL_PRIOR.get(config.protocol, 0.3)
+    if ledger and config.source:
+        score *= 0.5 + ledger.alive_ratio(config.source)
+    if history and config.ip:
+        success = history.success(endpoint_key(config.ip, config.port))
+        if success is not None:
+            score = HISTORY_WEIGHT * success + (1 - HISTORY_WEIGHT) * score
+    return score
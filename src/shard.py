@@ -0,0 +1,87 @@
+import json
+import logging
+from pathlib import Path
+from src.parser import parse_config
+
+logger = logging.getLogger(__name__)
+
+# Per-config result columns kept in a shard file, after raw and source
+FIELDS = ("latency", "ip", "dns_ms", "p50", "p90", "jitter", "loss", "tls_ms", "ttfb_ms", "throughput", "tls_resumed_ms")
+
+
+def parse_shard(spec):
+    """"i/N" -> (i, N) with 1 <= i <= N"""
+    index, _, count = spec.partition("/")
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise ValueError("shard must be i/N with 1 <= i <= N, got " + spec)
+    return index, count
+
+
+def in_shard(config, index, count):
+    # The fingerprint is a content digest, so every runner agrees on the
+    # split without coordinating (unlike hash(), which is salted per process)
+    return int.from_bytes(config.fingerprint[:8], "big") % count == index - 1
+
+
+def shard_path(result_dir, index, count):
+    return str(Path(result_dir) / ("shard-" + str(index) + "-of-" + str(count) + ".json"))
+
+
+def save_shard(configs, result_dir, index, count):
+    """Write this shard's tested configs compactly: metrics for alive ones, raw only
+    for dead ones and for those never probed (loss -1, see ConfigTester._unknown)"""
+    alive, dead, unprobed = [], [], []
+    for c in configs:
+        if c.is_alive:
+            alive.append([c.raw, c.source] + [getattr(c, f) for f in FIELDS])
+        elif c.loss < 0:
+            unprobed.append([c.raw, c.source])
+        else:
+            dead.append([c.raw, c.source])
+    path = shard_path(result_dir, index, count)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"shard": index, "of": count, "fields": ["raw", "source"] + list(FIELDS),
+                   "alive": alive, "dead": dead, "unprobed": unprobed}, f, ensure_ascii=False, separators=(",", ":"))
+    logger.info("Shard " + str(index) + "/" + str(count) + ": " + str(len(alive)) + " alive, " +
+                str(len(dead)) + " dead, " + str(len(unprobed)) + " unprobed -> " + path)
+    return path
+
+
+def _restore(row, state):
+    c = parse_config(row[0])
+    if not c:
+        return None
+    c.source = row[1]
+    if state == "alive":
+        for field, value in zip(FIELDS, row[2:]):
+            setattr(c, field, value)
+        c.is_alive = True
+    elif state == "dead":
+        c.loss = 1.0
+    return c
+
+
+def load_shards(result_dir):
+    """All configs from every shard file under result_dir, in shard order"""
+    paths = sorted(Path(result_dir).rglob("shard-*-of-*.json"),
+                   key=lambda p: int(p.name.split("-")[1]))
+    configs = []
+    seen = set()
+    counts = set()
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        counts.add(data["of"])
+        for state in ("alive", "dead", "unprobed"):
+            for row in data.get(state, []):
+                c = _restore(row, state)
+                if c and c.fingerprint not in seen:
+                    seen.add(c.fingerprint)
+                    configs.append(c)
+    expected = max(counts) if counts else 0
+    if len(paths) < expected or len(counts) > 1:
+        logger.warning("Merging " + str(len(paths)) + " shard files, expected " + str(expected))
+    logger.info("Merged " + str(len(configs)) + " configs from " + str(len(paths)) + " shards")
+    return configs
@@ -1,98 +1,356 @@
+import asyncio
+import math
 import socket
 import ssl
-import time
 import logging
-import urllib.parse
-import base64
-import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from src.resolver import get_resolver, group_by_endpoint
+from src.history import endpoint_key
+from src.connect import race_connect, race_connect_async
+from src.limits import abort_close, is_exhausted, probe_cap
+from src.concurrency import (AIMDController, DestinationLimiter, ProcessFanout, interleave, partition, subnet_of,
+                             submit_adaptive, run_adaptive)
 
 logger = logging.getLogger(__name__)
 
+# A timed-out sample may be a lost SYN; anything else (refused,
+# unreachable) means more samples of that endpoint are pointless
+TIMEOUTS = (socket.timeout, asyncio.TimeoutError)
+# Probe order is interleaved across subnets within slices of this many
+# endpoints, so the priority order holds at that granularity
+INTERLEAVE_WINDOW = 1000
+# Result of a probe this host had no descriptor or port for: neither alive
+# nor dead, and retried once after the first pass
+EXHAUSTED = "exhausted"
+
+
+def latency_stats(times, lost=0):
+    """(p50, p90, jitter, loss) from connect times in ms and the lost sample count.
+
+    Percentiles are nearest-rank; jitter is the mean gap between consecutive samples.
+    """
+    ordered = sorted(times)
+
+    def percentile(q):
+        return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+
+    gaps = [abs(b - a) for a, b in zip(times, times[1:])]
+    jitter = sum(gaps) / len(gaps) if gaps else 0.0
+    return (round(percentile(0.5), 1), round(percentile(0.9), 1), round(jitter, 1),
+            round(lost / (len(times) + lost), 3))
+
 
 class ConfigTester:
-    def __init__(self, timeout=3, max_workers=200):
+    def __init__(self, timeout=3, max_workers=200, mode="thread", concurrency=1000, resolver=None,
+                 history=None, samples=1, per_ip=8, per_subnet=64, prior=None, processes=1):
         self.timeout = timeout
-        self.max_workers = max_workers
+        # With processes > 1 endpoints are split by subnet over spawned
+        # worker processes, each running its own loop / pool over its share
+        # with the limits divided between them; results stream back here
+        self.processes = max(processes, 1)
+        # "async" keeps up to `concurrency` non-blocking connects in flight
+        # on one event loop instead of one blocking socket per thread.
+        # Both limits are ceilings: an AIMD controller picks the actual
+        # in-flight count from observed latency inflation and failures.
+        # They are further capped so every in-flight probe has an fd and a port.
+        self.mode = mode
+        self.max_workers = probe_cap(max_workers, self.processes)
+        self.concurrency = probe_cap(concurrency, self.processes)
+        # Hostnames are resolved once up front so DNS time is not counted
+        # as connect latency and shared names are looked up only once
+        self.resolver = resolver or get_resolver()
+        # Optional LatencyHistory: dead endpoints in backoff are not probed,
+        # the rest are probed best-first and get_best can rank by stability
+        self.history = history
+        # Connects per live endpoint; a dead one is given up on after the first
+        self.samples = max(samples, 1)
+        # Many configs share one CDN edge; bursts of SYNs at it get rate
+        # limited and read as dead, so probes per IP and /24 are capped
+        self.per_ip = per_ip
+        self.per_subnet = per_subnet
+        # Optional config -> estimated chance of being alive; likely-alive
+        # endpoints are probed first so a deadline cuts off the least useful
+        self.prior = prior
 
     def _resolve_address(self, config):
-        try:
-            if config.protocol == "vmess":
-                b64 = config.raw.replace("vmess://", "")
-                padding = 4 - len(b64) % 4
-                if padding != 4:
-                    b64 += "=" * padding
-                try:
-                    decoded = base64.b64decode(b64).decode("utf-8", errors="ignore")
-                except Exception:
-                    decoded = base64.urlsafe_b64decode(b64).decode("utf-8", errors="ignore")
-                data = json.loads(decoded)
-                return data.get("add", ""), int(data.get("port", 0))
-            elif config.protocol in ["vless", "trojan"]:
-                parsed = urllib.parse.urlparse(config.raw)
-                return parsed.hostname or "", parsed.port or 0
-            elif config.protocol == "ss":
-                raw = config.raw.replace("ss://", "")
-                if "#" in raw:
-                    raw = raw.split("#")[0]
-                if "@" in raw:
-                    server_part = raw.split("@")[1]
-                    host, port = server_part.rsplit(":", 1)
-                    return host, int(port)
-        except Exception:
-            pass
-        return config.address, config.port
+        return config.endpoint()
 
-    def test_single(self, config):
-        host, port = self._resolve_address(config)
+    def _connect(self, addresses, port):
+        """One racing connect; returns (winning address, ms) or raises OSError"""
+        sock, address, ms = race_connect(addresses, port, self.timeout)
+        abort_close(sock)
+        return address, ms
 
-        if not host or not port:
-            config.latency = -1
-            config.is_alive = False
-            return config
+    async def _connect_async(self, addresses, port):
+        sock, address, ms = await race_connect_async(addresses, port, self.timeout)
+        abort_close(sock)
+        return address, ms
 
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(self.timeout)
-            start = time.perf_counter()
-            sock.connect((host, port))
-            latency = (time.perf_counter() - start) * 1000
-            sock.close()
+    def _probe(self, addresses, port):
+        """(latency stats, winning address) over up to `samples` connects, or None if dead.
 
-            config.latency = round(latency, 1)
-            config.is_alive = True
-        except Exception:
+        The first connect races every resolved address; the rest measure the winner.
+        Raises the OSError if this host runs out of fds or ports before any answer.
+        """
+        times, lost = [], 0
+        for _ in range(self.samples):
+            try:
+                address, ms = self._connect(addresses, port)
+                addresses = (address,)
+                times.append(ms)
+            except Exception as e:
+                if is_exhausted(e):
+                    if not times:
+                        raise
+                    break
+                if not times:
+                    return None
+                lost += 1
+                if not isinstance(e, TIMEOUTS):
+                    break
+        return latency_stats(times, lost), addresses[0]
+
+    async def _probe_async(self, addresses, port):
+        times, lost = [], 0
+        for _ in range(self.samples):
+            try:
+                address, ms = await self._connect_async(addresses, port)
+                addresses = (address,)
+                times.append(ms)
+            except Exception as e:
+                if is_exhausted(e):
+                    if not times:
+                        raise
+                    break
+                if not times:
+                    return None
+                lost += 1
+                if not isinstance(e, TIMEOUTS):
+                    break
+        return latency_stats(times, lost), addresses[0]
+
+    def _unknown(self, config):
+        """Not probed this run: not alive, but nothing measured either (loss stays -1)"""
+        config.latency = -1
+        config.is_alive = False
+        config.p50 = config.p90 = config.jitter = config.loss = -1
+        return config
+
+    def _apply(self, config, result):
+        if result is None:
             config.latency = -1
             config.is_alive = False
-
+            config.p50 = config.p90 = config.jitter = -1
+            config.loss = 1.0
+        else:
+            (config.p50, config.p90, config.jitter, config.loss), config.ip = result
+            config.latency = config.p50
+            config.is_alive = True
         return config
 
-    def test_batch(self, configs):
-        logger.info("Testing " + str(len(configs)) + " configs...")
-        tested = []
-        alive = 0
+    def _target(self, config):
+        """(addresses, port) to race, or None; records the DNS time on the config"""
+        host, port = self._resolve_address(config)
+        if not host or not port:
+            return None
+        addresses, config.dns_ms = self.resolver.lookup(host)
+        if not addresses:
+            return None
+        config.ip = addresses[0]
+        return tuple(addresses), port
 
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            futures = {executor.submit(self.test_single, c): c for c in configs}
+    def test_single(self, config):
+        target = self._target(config)
+        if not target:
+            return self._apply(config, None)
+        return self._apply(config, self._probe(*target))
+
+    def _stop_at(self, deadline):
+        # A probe started later could still be running at the deadline
+        return deadline - self.timeout * self.samples if deadline else None
+
+    def _settle(self, controller, endpoint, result, on_result, retry=None):
+        """Feed a finished probe to the controller and on_result.
+
+        A probe that ran out of fds / ports counts as a failure, so the
+        controller backs off, and is held in `retry` when given.
+        """
+        if result == EXHAUSTED:
+            controller.observe(None)
+            if retry is not None:
+                retry.append(endpoint)
+                return
+        else:
+            controller.observe(result[0][0] if result else None)
+        on_result(endpoint, result)
+
+    def _retry_exhausted(self, retry):
+        if retry:
+            logger.warning("Resources: " + str(len(retry)) + " probes ran out of fds / ports, retrying them")
+        return retry
 
-            for future in as_completed(futures):
+    def _probe_all_threaded(self, endpoints, on_result, deadline=None):
+        controller = AIMDController(self.max_workers)
+        limiter = DestinationLimiter(self.per_ip, self.per_subnet)
+        for last in (False, True):
+            retry = None if last else []
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for endpoint, future in submit_adaptive(executor, lambda e: self._probe(*e), endpoints, controller,
+                                                        limiter, lambda e: e[0], self._stop_at(deadline)):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = EXHAUSTED if is_exhausted(e) else None
+                    self._settle(controller, endpoint, result, on_result, retry)
+            endpoints = self._retry_exhausted(retry)
+            if not endpoints:
+                break
+        controller.report()
+        limiter.report()
+
+    async def _probe_all_async(self, endpoints, on_result, deadline=None):
+        controller = AIMDController(self.concurrency)
+        limiter = DestinationLimiter(self.per_ip, self.per_subnet)
+        for last in (False, True):
+            retry = None if last else []
+            async for endpoint, task in run_adaptive(lambda e: self._probe_async(*e), endpoints, controller,
+                                                     limiter, lambda e: e[0], self._stop_at(deadline)):
                 try:
-                    result = future.result(timeout=self.timeout + 1)
-                    tested.append(result)
-                    if result.is_alive:
-                        alive += 1
-                except Exception:
-                    c = futures[future]
-                    c.latency = -1
-                    c.is_alive = False
-                    tested.append(c)
+                    result = task.result()
+                except Exception as e:
+                    result = EXHAUSTED if is_exhausted(e) else None
+                self._settle(controller, endpoint, result, on_result, retry)
+            endpoints = self._retry_exhausted(retry)
+            if not endpoints:
+                break
+        controller.report()
+        limiter.report()
+
+    def _fanout(self, endpoints):
+        """Split endpoints over worker processes, one subnet per process"""
+        partitions = partition(endpoints, self.processes, lambda e: subnet_of(e[0][0]))
+        settings = {
+            "timeout": self.timeout, "mode": self.mode, "samples": self.samples,
+            "max_workers": max(self.max_workers // self.processes, 1),
+            "concurrency": max(self.concurrency // self.processes, 1),
+            "per_ip": self.per_ip, "per_subnet": self.per_subnet,
+        }
+        return partitions, settings
+
+    def _collector(self, groups, results, on_alive=None):
+        def on_result(endpoint, result):
+            results[endpoint] = result
+            if result == EXHAUSTED:
+                return
+            for c in groups[endpoint]:
+                self._apply(c, result)
+            if on_alive and result:
+                on_alive(groups[endpoint])
+        return on_result
+
+    def _plan(self, configs):
+        """Resolve and group configs; return (groups, endpoints in probe order)"""
+        logger.info("Testing " + str(len(configs)) + " configs (" + self.mode + ")...")
+        self.resolver.resolve_all(self._resolve_address(c)[0] for c in configs)
+
+        # Probe each resolved endpoint once and fan the result out to every
+        # config on it. History is keyed by the address that answered, or
+        # by the first one when none did.
+        groups, unresolved = group_by_endpoint(configs, self.resolver)
+        for c in unresolved:
+            self._apply(c, None)
+        endpoints = list(groups)
+        if self.history:
+            endpoints, skipped = self.history.plan(endpoints, _history_keys)
+            for endpoint in skipped:
+                for c in groups[endpoint]:
+                    self._unknown(c)
+        if self.prior:
+            endpoints.sort(key=lambda e: max(self.prior(c) for c in groups[e]), reverse=True)
+        endpoints = interleave(endpoints, lambda e: subnet_of(e[0][0]), INTERLEAVE_WINDOW)
+        logger.info("Probing " + str(len(endpoints)) + " unique endpoints")
+        return groups, endpoints
 
+    def _finish(self, configs, groups, endpoints, results, lost=()):
+        """Apply results; endpoints in `lost` belonged to a worker process that failed"""
+        lost = [e for e in lost if e not in results]
+        exhausted = [e for e, result in results.items() if result == EXHAUSTED]
+        results = {e: result for e, result in results.items() if result != EXHAUSTED}
+        unprobed = [e for e in endpoints if e not in results]
+        # Cut off by the deadline, out of local fds / ports or lost with a
+        # worker: unknown rather than dead, so not recorded
+        for endpoint in unprobed:
+            for c in groups[endpoint]:
+                self._unknown(c)
+        if len(unprobed) > len(exhausted) + len(lost):
+            logger.warning("Deadline: " + str(len(unprobed) - len(exhausted) - len(lost)) +
+                           " endpoints left unprobed")
+        if lost:
+            logger.warning("Workers: " + str(len(lost)) + " endpoints lost with a failed probe process")
+        if exhausted:
+            logger.warning("Resources: " + str(len(exhausted)) + " endpoints not probed for lack of fds / ports")
+        if self.history:
+            # Alive under the address that answered; dead under every address
+            # raced, unless another endpoint reached that address this run
+            record = {endpoint_key(result[1], endpoint[1]): result[0][0]
+                      for endpoint, result in results.items() if result}
+            for endpoint, result in results.items():
+                if not result:
+                    for key in _history_keys(endpoint):
+                        record.setdefault(key, None)
+            self.history.record(record)
+            self.history.save()
+
+        alive = sum(len(groups[endpoint]) for endpoint, result in results.items() if result)
         logger.info("Alive: " + str(alive) + "/" + str(len(configs)))
-        return tested
+        return list(configs)
+
+    def test_batch(self, configs, deadline=None):
+        """Probe configs; no new probe starts that could outlast the monotonic deadline"""
+        if self.mode == "async":
+            return asyncio.run(self.test_batch_async(configs, deadline=deadline))
+        groups, endpoints = self._plan(configs)
+        results = {}
+        on_result = self._collector(groups, results)
+        lost = []
+        if self.processes > 1:
+            fanout = ProcessFanout(_probe_partition, *self._fanout(endpoints), deadline)
+            for endpoint, result in fanout:
+                on_result(endpoint, result)
+            lost = fanout.lost
+        else:
+            self._probe_all_threaded(endpoints, on_result, deadline)
+        return self._finish(configs, groups, endpoints, results, lost)
+
+    async def test_batch_async(self, configs, on_alive=None, deadline=None):
+        """test_batch on the running event loop.
 
-    def get_best(self, configs, top_n=300, max_latency=2000):
+        on_alive(group) receives the configs of each live endpoint as soon
+        as its probe finishes, so later stages can start on them early.
+        """
+        groups, endpoints = self._plan(configs)
+        results = {}
+        on_result = self._collector(groups, results, on_alive)
+        lost = []
+        if self.processes > 1:
+            fanout = ProcessFanout(_probe_partition, *self._fanout(endpoints), deadline)
+            async for endpoint, result in fanout:
+                on_result(endpoint, result)
+            lost = fanout.lost
+        else:
+            await self._probe_all_async(endpoints, on_result, deadline)
+        return self._finish(configs, groups, endpoints, results, lost)
+
+    def get_best(self, configs, top_n=300, max_latency=2000, rank="latency"):
+        """rank="stability" orders by historical latency and success instead of this
+        run's sample; rank="p90" by the slow tail of this run's samples"""
         alive = [c for c in configs if c.is_alive and 0 < c.latency <= max_latency]
-        alive.sort(key=lambda x: x.latency)
+        if rank == "stability" and self.history:
+            alive.sort(key=lambda x: self.history.stability(endpoint_key(x.ip, x.port), x.latency))
+        elif rank == "p90":
+            alive.sort(key=lambda x: (x.p90, x.loss))
+        else:
+            alive.sort(key=lambda x: x.latency)
 
         seen = set()
         unique = []
@@ -106,3 +364,23 @@ class ConfigTester:
         if best:
             logger.info("Best " + str(len(best)) + ": " + str(best[0].latency) + "ms ~ " + str(best[-1].latency) + "ms")
         return best
+
+
+def _history_keys(endpoint):
+    addresses, port = endpoint
+    return [endpoint_key(address, port) for address in addresses]
+
+
+def _probe_partition(index, endpoints, queue, settings, deadline):
+    """Worker process body: probe one partition and stream (endpoint, result) back"""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [probe " + str(index) + "] %(message)s",
+                        datefmt="%H:%M:%S")
+    tester = ConfigTester(**settings)
+
+    def on_result(endpoint, result):
+        queue.put((endpoint, result))
+
+    if tester.mode == "async":
+        asyncio.run(tester._probe_all_async(endpoints, on_result, deadline))
+    else:
+        tester._probe_all_threaded(endpoints, on_result, deadline)
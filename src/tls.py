@@ -0,0 +1,82 @@
+import logging
+import ssl
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Sessions kept for resumption; one per (ip, sni), oldest dropped first
+MAX_SESSIONS = 4096
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+_shared = None
+
+
+def probe_context(alpn=None):
+    """Client context for probing, built once per ALPN profile and shared.
+
+    Certificates are not verified: the probe only cares that the edge
+    completes a handshake for the SNI, and loading the CA store per probe
+    costs more than the handshake itself.
+    """
+    profile = tuple(alpn) if alpn else ()
+    with _contexts_lock:
+        ctx = _contexts.get(profile)
+        if ctx is None:
+            ctx = ssl.create_default_context()
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+            if profile:
+                ctx.set_alpn_protocols(list(profile))
+            _contexts[profile] = ctx
+    return ctx
+
+
+def _median(values):
+    ordered = sorted(values)
+    return round(ordered[len(ordered) // 2], 1) if ordered else -1
+
+
+class SessionCache:
+    """TLS sessions by (ip, sni), so repeat probes of one edge can resume"""
+
+    def __init__(self, size=MAX_SESSIONS):
+        self.size = size
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.full_ms = []
+        self.resumed_ms = []
+
+    def get(self, ip, sni):
+        with self._lock:
+            session = self._sessions.get((ip, sni))
+            if session is not None:
+                self._sessions.move_to_end((ip, sni))
+            return session
+
+    def put(self, ip, sni, session):
+        if session is None:
+            return
+        with self._lock:
+            self._sessions[(ip, sni)] = session
+            self._sessions.move_to_end((ip, sni))
+            while len(self._sessions) > self.size:
+                self._sessions.popitem(last=False)
+
+    def record(self, ms, resumed):
+        (self.resumed_ms if resumed else self.full_ms).append(ms)
+
+    def report(self, label="TLS"):
+        if self.full_ms or self.resumed_ms:
+            logger.info(label + ": " + str(len(self.full_ms)) + " full handshakes (median " +
+                        str(_median(self.full_ms)) + " ms), " + str(len(self.resumed_ms)) +
+                        " resumed (median " + str(_median(self.resumed_ms)) + " ms)")
+
+
+def get_session_cache():
+    """Process-wide session cache so all probes in a run resume from one another"""
+    global _shared
+    if _shared is None:
+        _shared = SessionCache()
+    return _shared
@@ -13,41 +13,24 @@ REPO = "imTruck/MWRI"
 RAW_BASE = "https://raw.githubusercontent.com/" + REPO + "/main/"
 
 
-def rename_config(raw, protocol, number, flag=""):
+def rename_config(config, number, flag=""):
     new_name = flag + " " + PREFIX + " #" + str(number) if flag else PREFIX + " #" + str(number)
-    try:
-        if protocol == "vmess":
-            b64 = raw.replace("vmess://", "")
-            padding = 4 - len(b64) % 4
-            if padding != 4:
-                b64 += "=" * padding
-            try:
-                decoded = base64.b64decode(b64).decode("utf-8", errors="ignore")
-            except Exception:
-                decoded = base64.urlsafe_b64decode(b64).decode("utf-8", errors="ignore")
-            data = json.loads(decoded)
-            data["ps"] = new_name
-            new_json = json.dumps(data, ensure_ascii=False)
-            return "vmess://" + base64.b64encode(new_json.encode("utf-8")).decode("utf-8")
-        else:
-            if "#" in raw:
-                base_part = raw.rsplit("#", 1)[0]
-            else:
-                base_part = raw
-            return base_part + "#" + urllib.parse.quote(new_name, safe="")
-    except Exception:
-        if "#" in raw:
-            base_part = raw.rsplit("#", 1)[0]
-        else:
-            base_part = raw
-        return base_part + "#" + urllib.parse.quote(new_name, safe="")
+    renamed = config.renamed(new_name)
+    if renamed:
+        return renamed.raw
+    raw = config.raw
+    if "#" in raw:
+        base_part = raw.rsplit("#", 1)[0]
+    else:
+        base_part = raw
+    return base_part + "#" + urllib.parse.quote(new_name, safe="")
 
 
 def rename_all(configs):
     renamed = []
     for i, c in enumerate(configs, 1):
         flag = get_flag(c.address)
-        renamed.append(rename_config(c.raw, c.protocol, i, flag))
+        renamed.append(rename_config(c, i, flag))
     return renamed
 
 
@@ -81,7 +64,9 @@ def save_json(configs, filepath):
         data["configs"].append({
             "name": name, "protocol": c.protocol,
             "address": c.address, "port": c.port,
-            "latency_ms": c.latency, "raw": renamed[i - 1],
+            "latency_ms": c.latency, "p50_ms": c.p50, "p90_ms": c.p90,
+            "jitter_ms": c.jitter, "loss": c.loss, "ttfb_ms": c.ttfb_ms,
+            "throughput_bps": c.throughput, "raw": renamed[i - 1],
         })
     with open(filepath, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)